@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""
+A fake docker daemon for the benchmarks. It answers the requests
+docker_simple sends over the unix socket, on the state in fake_state.py,
+and records every request.
+
+Usage: fake_daemon.py <socket path>
+"""
+
+import os
+import re
+import sys
+import json
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+import fake_state
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of one connection (they are kept open).
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return 'unix'
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        fake_state.log_call(method + ' ' + self.path)
+        url = urlparse(self.path)
+        path = re.sub(r'^/v[\d.]+/', '/', unquote(url.path))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+        with fake_state.locked_state() as state:
+            status, response = self.route(state, method, path, parse_qs(url.query), body)
+
+        if response is None:
+            data = b''
+        elif isinstance(response, bytes):
+            data = response
+        else:
+            data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        if response is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    @staticmethod
+    def route(state, method, path, query, body):
+        """
+        Answer a request.
+
+        :return: A tuple with the status and the response (None for none,
+                 bytes are sent as they are).
+        """
+
+        if path == '/_ping':
+            return 200, None
+
+        if path in ('/containers/json', '/images/json') and method == 'GET':
+            objects = state['containers'] if path == '/containers/json' else state['images']
+            return 200, [dict(Id=object_id) for object_id in sorted(objects)]
+
+        if path == '/events' and method == 'GET':
+            types = json.loads(query.get('filters', ['{}'])[0]).get('type')
+            found = fake_state.events_between(state, float(query['since'][0]), float(query['until'][0]))
+            # The events are streamed, one JSON object per line
+            return 200, b''.join(json.dumps(event).encode('utf-8') + b'\n'
+                                 for event in found if not types or event['Type'] in types)
+
+        match = re.match(r'^/(containers|images)/(.+)/json$', path)
+        if match and method == 'GET':
+            find = fake_state.find_container if match.group(1) == 'containers' else fake_state.find_image
+            found = find(state, match.group(2))
+            return (200, found) if found else (404, dict(message='No such object: ' + match.group(2)))
+
+        match = re.match(r'^/images/(.+)/history$', path)
+        if match and method == 'GET':
+            image = fake_state.find_image(state, match.group(1))
+            if image is None:
+                return 404, dict(message='No such image: ' + match.group(1))
+            return 200, [dict(Size=size) for size in state['history'][image['Id']]]
+
+        match = re.match(r'^/images/([^/]+)$', path)
+        if match and method == 'DELETE':
+            image = fake_state.find_image(state, match.group(1))
+            if image is None:
+                return 404, dict(message='No such image: ' + match.group(1))
+            if any(container['Image'] == image['Id'] for container in state['containers'].values()):
+                return 409, dict(message='conflict: unable to delete %s (image is being used)' % match.group(1))
+            del state['images'][image['Id']]
+            fake_state.add_event(state, 'image', 'delete', image['Id'])
+            return 200, [dict(Deleted=image['Id'])]
+
+        if path == '/containers/create' and method == 'POST':
+            image = fake_state.find_image(state, body['Image'])
+            if image is None:
+                return 404, dict(message='No such image: ' + body['Image'])
+            config = dict((key, value) for key, value in body.items() if key != 'HostConfig')
+            container = fake_state.add_container(state, query['name'][0], image, config, body.get('HostConfig') or dict())
+            if container is None:
+                return 409, dict(message='Conflict. The container name is already in use')
+            return 201, dict(Id=container['Id'], Warnings=[])
+
+        match = re.match(r'^/containers/([^/]+)(?:/(\w+))?$', path)
+        if match:
+            container = fake_state.find_container(state, match.group(1))
+            if container is None:
+                return 404, dict(message='No such container: ' + match.group(1))
+            action = match.group(2) or method.lower()
+            if action in ('start', 'stop') and container['State']['Running'] == (action == 'start'):
+                return 304, None
+            if action in ('start', 'restart', 'stop'):
+                fake_state.set_running(state, container, action != 'stop')
+            elif action == 'delete':
+                if container['State']['Running']:
+                    return 409, dict(message='You cannot remove a running container')
+                del state['containers'][container['Id']]
+            elif action == 'rename':
+                if fake_state.find_container(state, query['name'][0]):
+                    return 409, dict(message='Conflict. The name is already in use')
+                container['Name'] = '/' + query['name'][0]
+            elif action == 'kill':
+                signal = query.get('signal', ['KILL'])[0]
+                container.setdefault('Signals', []).append(signal)
+                if signal in ('KILL', 'SIGKILL', '9'):
+                    fake_state.set_running(state, container, False)
+            elif action == 'update':
+                container.setdefault('Updates', []).append(body)
+                fake_state.add_event(state, 'container', 'update', container['Id'])
+                return 200, dict(Warnings=[])
+            else:
+                return 404, dict(message='page not found')
+            if action not in ('start', 'restart', 'stop'):
+                fake_state.add_event(state, 'container', 'destroy' if action == 'delete' else action, container['Id'])
+            return 204, None
+
+        return 404, dict(message='page not found')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main(socket_path):
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    Server(socket_path, Handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
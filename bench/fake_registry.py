@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+A fake docker registry for the checks. It answers the manifest requests
+docker_simple sends for 'pull_check: digest' with the digests in
+fake_state.py (which the fake 'docker pull' records as well), and only
+after a token was fetched, like Docker Hub does. Every request is recorded.
+
+Usage: fake_registry.py <port file>
+
+The registry listens on a free port of 127.0.0.1, which it writes to the
+port file once it's ready. Images are referenced as 'localhost:<port>/...'.
+"""
+
+import os
+import re
+import sys
+import json
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import fake_state
+
+TOKEN = 'fake-token'
+
+MANIFEST_LIST_TYPE = 'application/vnd.docker.distribution.manifest.list.v2+json'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Handles the requests of one connection.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def handle_request(self, method):
+        fake_state.log_call(method + ' ' + self.path)
+        url = urlparse(self.path)
+        host = self.headers.get('Host')
+
+        if url.path == '/token' and method == 'GET':
+            return self.reply(200, dict(token=TOKEN))
+
+        match = re.match(r'^/v2/(.+)/manifests/([^/]+)$', url.path)
+        if not match:
+            return self.reply(404, dict(errors=[dict(code='NOT_FOUND')]))
+        repository, tag = match.groups()
+
+        if self.headers.get('Authorization') != 'Bearer ' + TOKEN:
+            challenge = 'Bearer realm="http://%s/token",service="fake-registry",scope="repository:%s:pull"' % (
+                host, repository)
+            return self.reply(401, dict(errors=[dict(code='UNAUTHORIZED')]), {'WWW-Authenticate': challenge})
+        if MANIFEST_LIST_TYPE not in self.headers.get('Accept', ''):
+            return self.reply(400, dict(errors=[dict(code='MANIFEST_UNKNOWN')]))
+
+        with fake_state.locked_state() as state:
+            digest = state.get('registry', dict()).get('%s/%s:%s' % (host, repository, tag))
+        if digest is None:
+            return self.reply(404, dict(errors=[dict(code='MANIFEST_UNKNOWN')]))
+        return self.reply(200, None, {'Docker-Content-Digest': digest, 'Content-Type': MANIFEST_LIST_TYPE})
+
+    def reply(self, status, response, headers=None):
+        data = b'' if response is None else json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        if response is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        # HEAD requests get the headers only
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(port_path):
+    server = Server(('127.0.0.1', 0), Handler)
+    with open(port_path + '.tmp', 'w') as port_file:
+        port_file.write(str(server.server_address[1]))
+    os.rename(port_path + '.tmp', port_path)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
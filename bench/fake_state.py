@@ -0,0 +1,212 @@
+"""
+The state of the fake docker daemon the benchmarks run against. The fake
+'docker' command and the fake daemon share it through a JSON file, so a
+container created by one of them is seen by the other one as well.
+
+Only what docker_simple needs is implemented. Nothing is actually built,
+pulled or run, the objects just look like the real ones when inspected.
+"""
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+import datetime
+import contextlib
+
+# The file with the state, shared by the command and the daemon
+STATE_ENV = 'FAKE_DOCKER_STATE'
+
+# Every call of the command (every request to the daemon) is appended to this
+# file, that's how the benchmarks count them.
+LOG_ENV = 'FAKE_DOCKER_LOG'
+
+# Seconds every call of the command (every request to the daemon) takes
+LATENCY_ENV = 'FAKE_DOCKER_LATENCY'
+
+
+@contextlib.contextmanager
+def locked_state():
+    """
+    Load the state while holding a lock on it and write it back afterwards.
+
+    :return: A context manager that yields the state.
+    """
+
+    path = os.environ[STATE_ENV]
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            state = dict(containers=dict(), images=dict(), events=[])
+        yield state
+        with open(path + '.tmp', 'w') as state_file:
+            json.dump(state, state_file)
+        os.rename(path + '.tmp', path)
+
+
+def log_call(line):
+    """
+    Record a call of the command or a request to the daemon and simulate
+    the time it takes.
+
+    :param line: What to record.
+    """
+
+    path = os.environ.get(LOG_ENV)
+    if path:
+        with open(path, 'a') as log_file:
+            log_file.write(line + '\n')
+    latency = float(os.environ.get(LATENCY_ENV) or 0)
+    if latency:
+        time.sleep(latency)
+
+
+def new_id(seed):
+    """
+    :param seed: Something that makes the ID unique.
+    :return: A new object ID (64 hex digits).
+    """
+
+    return hashlib.sha256((seed + repr(time.time())).encode('utf-8')).hexdigest()
+
+
+def now():
+    """
+    :return: The current time, formatted the way docker does it.
+    """
+
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f') + '000Z'
+
+
+def normalize_ref(ref):
+    """
+    :param ref: An image reference.
+    :return: The reference with the ':latest' tag if it has none.
+    """
+
+    if '@' in ref or ':' in ref.split('/')[-1]:
+        return ref
+    return ref + ':latest'
+
+
+def add_event(state, object_type, action, object_id):
+    """
+    Record an event, the way the daemon reports them.
+
+    :param state: The state.
+    :param object_type: 'container' or 'image'.
+    :param action: What happened, e.g. 'start'.
+    :param object_id: The ID of the object.
+    """
+
+    now_ns = time.time_ns()
+    state.setdefault('events', []).append(dict(Type=object_type, Action=action, Actor=dict(ID=object_id),
+                                               time=now_ns // 1000000000, timeNano=now_ns))
+
+
+def events_between(state, since, until):
+    """
+    :param state: The state.
+    :param since: The start of the period (seconds since the epoch).
+    :param until: The end of the period.
+    :return: The events in the period.
+    """
+
+    return [event for event in state.get('events', []) if since <= event['timeNano'] / 1e9 <= until]
+
+
+def find_image(state, ref):
+    """
+    :param state: The state.
+    :param ref: An image reference or ID.
+    :return: The image or None if it doesn't exist.
+    """
+
+    ref = ref[len('sha256:'):] if ref.startswith('sha256:') else ref
+    for image in state['images'].values():
+        if normalize_ref(ref) in image['RepoTags'] or image['Id'] == 'sha256:' + ref:
+            return image
+    return None
+
+
+def find_container(state, ref):
+    """
+    :param state: The state.
+    :param ref: A container name or (abbreviated, at least 12 digits) ID.
+    :return: The container or None if it doesn't exist.
+    """
+
+    for container in state['containers'].values():
+        if container['Name'] == '/' + ref or (len(ref) >= 12 and container['Id'].startswith(ref)):
+            return container
+    return None
+
+
+def add_image(state, ref, labels=None, digest=None):
+    """
+    Create an image and move the tag to it.
+
+    :param state: The state.
+    :param ref: The reference the image is tagged with.
+    :param labels: The labels of the image.
+    :param digest: The digest of the image in its registry.
+    :return: The image.
+    """
+
+    ref = normalize_ref(ref)
+    for image in state['images'].values():
+        if ref in image['RepoTags']:
+            image['RepoTags'].remove(ref)
+    image_id = 'sha256:' + new_id(ref)
+    # Every version of an image shares its bottom layer with the others
+    base_layer = 'sha256:' + hashlib.sha256(ref.rsplit(':', 1)[0].encode('utf-8')).hexdigest()
+    layers = [base_layer, 'sha256:' + new_id(image_id)]
+    image = dict(Id=image_id, RepoTags=[ref], Created=now(), Size=1024 * 1024,
+                 RepoDigests=[ref.rsplit(':', 1)[0] + '@' + digest] if digest else [],
+                 Config=dict(Labels=labels or dict()), RootFS=dict(Type='layers', Layers=layers))
+    state['images'][image_id] = image
+    # The sizes of the build steps, newest first (the CMD added no layer)
+    state.setdefault('history', dict())[image_id] = [0, 256 * 1024, 768 * 1024]
+    add_event(state, 'image', 'tag', image_id)
+    return image
+
+
+def add_container(state, name, image, config, host_config):
+    """
+    Create a container.
+
+    :param state: The state.
+    :param name: The name of the container.
+    :param image: The image of the container.
+    :param config: The config of the container (as in the API).
+    :param host_config: The host config of the container (as in the API).
+    :return: The container or None if the name is already in use.
+    """
+
+    if find_container(state, name):
+        return None
+    container_id = new_id(name)
+    container = dict(Id=container_id, Name='/' + name, Image=image['Id'], Created=now(),
+                     State=dict(Status='created', Running=False, ExitCode=0),
+                     Config=dict(config, Image=config.get('Image')), HostConfig=host_config)
+    state['containers'][container_id] = container
+    add_event(state, 'container', 'create', container_id)
+    return container
+
+
+def set_running(state, container, running):
+    """
+    Start or stop a container.
+
+    :param state: The state.
+    :param container: The container.
+    :param running: Whether it runs afterwards.
+    """
+
+    add_event(state, 'container', 'start' if running else 'die', container['Id'])
+    container['State']['Running'] = running
+    container['State']['Status'] = 'running' if running else 'exited'
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Checks how long importing docker_simple takes. Ansible starts a new
+interpreter for every task, so this is paid for every single task.
+
+Usage: import_time.py [options]
+
+The module is imported with 'python -X importtime' after ansible (which every
+module needs anyway), so only what the module itself imports is measured.
+The check fails (exit code 1) if the median import time exceeds the budget
+or if one of the modules that must not be imported at startup was imported.
+The results are printed as a JSON document.
+"""
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRARY_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'library')
+
+# Slow to import and only needed by some tasks (or not at all anymore)
+FORBIDDEN = ['distutils', 'setuptools', 'pkg_resources', 'six', 'urllib.request', 'concurrent.futures', 'http.client']
+
+
+def measure(python):
+    """
+    Import the module once in a new interpreter.
+
+    :param python: The python interpreter to use.
+    :return: A tuple with the import time of the module in milliseconds and
+             the list of the modules it imported.
+    """
+
+    env = dict(os.environ, PYTHONPATH=LIBRARY_DIR + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    output = subprocess.run([python, '-X', 'importtime', '-c', 'import ansible.module_utils.basic; import docker_simple'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True).stderr
+
+    # 'import time: <self us> | <cumulative us> | <indented name>', the
+    # modules ansible imported come before the 'import ansible...' line
+    imported = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        if name == 'ansible.module_utils.basic':
+            imported = []
+        elif name == 'docker_simple':
+            return int(cumulative) / 1000.0, imported
+        else:
+            imported.append(name)
+    raise RuntimeError('docker_simple was not imported:\n' + output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    # About twice what we measured (8-9 ms), so only real regressions fail
+    parser.add_argument('--budget', type=float, default=15.0,
+                        help='Maximal median import time in milliseconds (default 15)')
+    parser.add_argument('--repeat', type=int, default=5, help='How often the module is imported (default 5)')
+    parser.add_argument('--python', default=sys.executable, help='The python interpreter to use')
+    options = parser.parse_args()
+
+    # The first import may have to compile the module
+    measure(options.python)
+    times = []
+    for _ in range(options.repeat):
+        milliseconds, imported = measure(options.python)
+        times.append(milliseconds)
+
+    forbidden = sorted(name for name in imported if name.split('.')[0] in FORBIDDEN or name in FORBIDDEN)
+    median = statistics.median(times)
+    report = dict(median_ms=round(median, 1), min_ms=round(min(times), 1), max_ms=round(max(times), 1),
+                  budget_ms=options.budget, forbidden_imports=forbidden, modules_imported=len(imported),
+                  ok=median <= options.budget and not forbidden)
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0 if report['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the overhead of docker_simple itself. The module is run
+in-process against a fake 'docker' command (bench/docker) and a fake docker
+daemon (bench/fake_daemon.py), so what is measured is the module plus the
+latency you give the fakes, never docker.
+
+Usage: run_benchmarks.py [options] > results.json
+
+The results are a single JSON document. For every scenario and backend it
+contains the wall time per task and how often per task the 'docker' command
+was started ('forks') and how many requests were sent to the daemon.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+import subprocess
+
+from ansible.module_utils import basic
+from ansible.module_utils.common.text.converters import to_bytes
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'library'))
+
+import docker_simple  # noqa: E402
+import fake_state  # noqa: E402
+
+BACKENDS = ['cli', 'api']
+SCENARIOS = ['no_change', 'argument_change', 'rebuild_detection', 'multi_container']
+
+
+class Environment(object):
+    """
+    A fake docker (the command and the daemon) with its own state, and a
+    state directory for the module.
+    """
+
+    def __init__(self, work_dir, backend, cli_latency, api_latency):
+        """
+        :param work_dir: The directory to create everything in.
+        :param backend: 'cli' or 'api'.
+        :param cli_latency: Seconds every call of the 'docker' command takes.
+        :param api_latency: Seconds every request to the daemon takes.
+        """
+
+        self.backend = backend
+        self.dir = tempfile.mkdtemp(prefix=backend + '-', dir=work_dir)
+        self.cli_log = os.path.join(self.dir, 'cli.log')
+        self.api_log = os.path.join(self.dir, 'api.log')
+        socket_path = os.path.join(self.dir, 'docker.sock')
+
+        self.saved_environ = dict(os.environ)
+        os.environ.update({'PATH': BENCH_DIR + os.pathsep + os.environ.get('PATH', ''),
+                           'DOCKER_HOST': 'unix://' + socket_path,
+                           fake_state.STATE_ENV: os.path.join(self.dir, 'state.json'),
+                           fake_state.LOG_ENV: self.cli_log,
+                           fake_state.LATENCY_ENV: str(cli_latency)})
+        os.environ.pop('DOCKER_CONTEXT', None)
+        docker_simple.DOCKER_COMMANDS_PATH = os.path.join(self.dir, 'module')
+
+        self.daemon = None
+        if backend == 'api':
+            self.daemon = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_daemon.py'), socket_path],
+                                           env=dict(os.environ, **{fake_state.LOG_ENV: self.api_log,
+                                                                   fake_state.LATENCY_ENV: str(api_latency)}))
+            deadline = time.time() + 10
+            while not os.path.exists(socket_path):
+                if time.time() > deadline or self.daemon.poll() is not None:
+                    raise RuntimeError("The fake docker daemon didn't start")
+                time.sleep(0.01)
+
+    def close(self):
+        if self.daemon:
+            self.daemon.kill()
+            self.daemon.wait()
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def calls(self):
+        """
+        :return: A tuple with the number of calls of the 'docker' command
+                 and requests to the daemon so far.
+        """
+
+        counts = []
+        for path in (self.cli_log, self.api_log):
+            try:
+                with open(path) as log_file:
+                    counts.append(sum(1 for _ in log_file))
+            except IOError:
+                counts.append(0)
+        return tuple(counts)
+
+    def task(self, args):
+        """
+        Run the module once, the way ansible would.
+
+        :param args: The module arguments.
+        :return: The result of the module.
+        """
+
+        args = dict(args, backend=self.backend)
+        basic._ANSIBLE_ARGS = to_bytes(json.dumps(dict(ANSIBLE_MODULE_ARGS=args)))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                docker_simple.run_module()
+            except SystemExit:
+                pass
+        return json.loads(output.getvalue())
+
+    def measure(self, scenario, args, count, before=None):
+        """
+        Run the module a number of times and summarize how it went.
+
+        :param scenario: The name of the scenario.
+        :param args: A function returning the module arguments for the n-th task.
+        :param count: How many tasks to run.
+        :param before: A function that is called with n before the n-th task
+                       (not measured).
+        :return: A dict with the summary.
+        """
+
+        wall_times = []
+        changed = failed = 0
+        forks = requests = 0
+        for n in range(count):
+            if before:
+                before(n)
+            task_args = args(n)
+            cli_calls, api_calls = self.calls()
+            start = time.perf_counter()
+            result = self.task(task_args)
+            wall_times.append(time.perf_counter() - start)
+            cli_after, api_after = self.calls()
+            forks += cli_after - cli_calls
+            requests += api_after - api_calls
+            changed += bool(result.get('changed'))
+            failed += bool(result.get('failed'))
+
+        return dict(scenario=scenario, backend=self.backend, tasks=count,
+                    containers=len(task_args.get('containers') or [task_args]),
+                    wall_time=summarize(wall_times),
+                    forks_per_task=forks / float(count),
+                    api_requests_per_task=requests / float(count),
+                    changed_tasks=changed, failed_tasks=failed)
+
+
+def summarize(values):
+    """
+    :param values: A list of wall times.
+    :return: A dict with statistics about them (in seconds).
+    """
+
+    ordered = sorted(values)
+    return dict(mean=statistics.mean(ordered), median=statistics.median(ordered),
+                min=ordered[0], max=ordered[-1], p95=ordered[max(0, int(round(0.95 * len(ordered))) - 1)])
+
+
+def make_context(path, files):
+    """
+    Create a synthetic build context.
+
+    :param path: The directory of the context.
+    :param files: How many files it contains (1000 per directory).
+    """
+
+    os.makedirs(path)
+    with open(os.path.join(path, 'Dockerfile'), 'w') as dockerfile:
+        dockerfile.write('FROM scratch\nCOPY . /\n')
+    for n in range(files):
+        directory = os.path.join(path, 'dir%04d' % (n // 1000))
+        if n % 1000 == 0:
+            os.mkdir(directory)
+        fd = os.open(os.path.join(directory, 'file%04d.txt' % (n % 1000)), os.O_WRONLY | os.O_CREAT, 0o644)
+        os.write(fd, b'file %d\n' % n)
+        os.close(fd)
+
+
+def no_change(env, options):
+    """
+    A container that is running with the arguments it should have.
+    """
+
+    args = dict(name='bench', image='bench/app', state='running')
+    env.task(args)
+    return [env.measure('no_change', lambda n: args, options.repeat)]
+
+
+def argument_change(env, options):
+    """
+    A container whose arguments change every time, so it's recreated.
+    """
+
+    def args(n):
+        return dict(name='bench', image='bench/app', state='running', env=['BENCH_TASK=%d' % n])
+
+    env.task(args(-1))
+    return [env.measure('argument_change', args, options.repeat)]
+
+
+def rebuild_detection(env, options):
+    """
+    Local images with build contexts of different sizes: the first build
+    (nothing indexed yet), no change, a file that was touched without
+    changing it and a file that was changed.
+    """
+
+    results = []
+    for files in options.context_sizes:
+        path = os.path.join(env.dir, 'context%d' % files)
+        make_context(path, files)
+        args = dict(name='ctx%d' % files, image='bench/ctx%d' % files, path=path, state='built')
+        changed_file = os.path.join(path, 'dir0000', 'file0000.txt')
+
+        def touch(n):
+            os.utime(changed_file, None)
+
+        def modify(n):
+            with open(changed_file, 'a') as f:
+                f.write('change %d\n' % n)
+
+        results.append(env.measure('rebuild_first_%d' % files, lambda n: args, 1))
+        results.append(env.measure('rebuild_no_change_%d' % files, lambda n: args, options.context_repeat))
+        results.append(env.measure('rebuild_touched_%d' % files, lambda n: args, options.context_repeat, touch))
+        results.append(env.measure('rebuild_modified_%d' % files, lambda n: args, options.context_repeat, modify))
+        shutil.rmtree(path)
+    return results
+
+
+def multi_container(env, options):
+    """
+    Many containers in one task, one after another and in parallel, and
+    the same containers with one task each.
+    """
+
+    entries = [dict(name='bench%d' % n, image='bench/app%d' % n) for n in range(options.containers)]
+    env.task(dict(containers=entries, state='running'))
+
+    results = [env.measure('multi_container', lambda n: dict(containers=entries, state='running'), options.repeat),
+               env.measure('multi_container_parallel',
+                           lambda n: dict(containers=entries, state='running', parallel=options.parallel),
+                           options.repeat)]
+
+    single = env.measure('multi_container_single_tasks', lambda n: dict(entries[n % len(entries)], state='running'),
+                         options.repeat * len(entries))
+    single['containers'] = len(entries)
+    results.append(single)
+    return results
+
+
+def revision():
+    """
+    :return: The git revision of the module or None if it's unknown.
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='Run only this scenario (can be given more than once)')
+    parser.add_argument('--backend', action='append', choices=BACKENDS,
+                        help='Use only this backend (can be given more than once)')
+    parser.add_argument('--repeat', type=int, default=20, help='Tasks per measurement (default 20)')
+    parser.add_argument('--context-sizes', default='10000,100000,1000000',
+                        help='Files in the synthetic build contexts (default 10000,100000,1000000)')
+    parser.add_argument('--context-repeat', type=int, default=3,
+                        help='Tasks per measurement of the build contexts (default 3)')
+    parser.add_argument('--containers', type=int, default=20, help='Containers for multi_container (default 20)')
+    parser.add_argument('--parallel', type=int, default=4, help='Parallel containers for multi_container (default 4)')
+    parser.add_argument('--cli-latency', type=float, default=0.0,
+                        help="Seconds every call of the fake 'docker' command takes (default 0)")
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='Seconds every request to the fake daemon takes (default 0)')
+    parser.add_argument('--work-dir', default=None, help='Where to create the fakes and build contexts')
+    parser.add_argument('--output', default=None, help='Write the results to this file instead of stdout')
+    options = parser.parse_args()
+    options.context_sizes = [int(size) for size in options.context_sizes.split(',') if size]
+
+    scenarios = options.scenario or SCENARIOS
+    backends = options.backend or BACKENDS
+    results = []
+    for scenario in scenarios:
+        # The build context is scanned the same way with every backend
+        for backend in backends[:1] if scenario == 'rebuild_detection' else backends:
+            env = Environment(options.work_dir, backend, options.cli_latency, options.api_latency)
+            try:
+                results.extend(globals()[scenario](env, options))
+            finally:
+                env.close()
+            sys.stderr.write('%s (%s) done\n' % (scenario, backend))
+
+    report = dict(revision=revision(), python=platform.python_version(), platform=platform.platform(),
+                  options=dict((key, value) for key, value in vars(options).items() if key not in ('output', 'work_dir')),
+                  results=results)
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
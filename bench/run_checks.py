@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+"""
+Functional checks of docker_simple. Like the benchmarks, the module is run
+in-process against the fakes in bench/, so docker is never involved.
+
+Usage: run_checks.py [options]
+
+Every check runs with every backend. The failed checks are printed with
+what went wrong and the exit code is 1 if there are any.
+"""
+
+import os
+import sys
+import time
+import argparse
+import traceback
+import subprocess
+
+import fake_state
+from run_benchmarks import Environment, BACKENDS, BENCH_DIR
+
+CHECKS = ['plan_local_image_chain', 'pull_check_digest']
+
+
+class CheckFailed(Exception):
+    """
+    Raised if the module doesn't do what a check expects.
+    """
+
+    pass
+
+
+def expect(condition, message, *args):
+    """
+    :param condition: What has to be true.
+    :param message: The message if it isn't, formatted with args.
+    :raises CheckFailed: If the condition is false.
+    """
+
+    if not condition:
+        raise CheckFailed(message % args)
+
+
+def write_file(path, content):
+    """
+    Create a file and the directories it is in.
+
+    :param path: The path of the file.
+    :param content: What to write into it.
+    """
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def actions(result):
+    """
+    Get what a real run did to a container, in the terms of the plan of check
+    mode.
+
+    :param result: The result of the container.
+    :return: A list with the actions.
+    """
+
+    found = []
+    reasons = result['change_reason']
+    if "Executed 'docker build'" in reasons:
+        found.append('build')
+    if "Executed 'docker rm'" in reasons and "Executed 'docker run'" in reasons:
+        found.append('recreate')
+    elif "Executed 'docker run'" in reasons:
+        found.append('run')
+    return found
+
+
+class FakeRegistry(object):
+    """
+    The fake registry (bench/fake_registry.py), running next to the fake
+    docker of an Environment.
+    """
+
+    def __init__(self, env):
+        """
+        :param env: The Environment.
+        """
+
+        port_path = os.path.join(env.dir, 'registry.port')
+        self.log = os.path.join(env.dir, 'registry.log')
+        self.process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_registry.py'), port_path],
+                                        env=dict(os.environ, **{fake_state.LOG_ENV: self.log,
+                                                                fake_state.LATENCY_ENV: '0'}))
+        deadline = time.time() + 10
+        while not os.path.exists(port_path):
+            if time.time() > deadline or self.process.poll() is not None:
+                raise RuntimeError("The fake registry didn't start")
+            time.sleep(0.01)
+        with open(port_path) as port_file:
+            self.host = 'localhost:' + port_file.read().strip()
+
+    def close(self):
+        self.process.kill()
+        self.process.wait()
+
+    def push(self, ref, digest):
+        """
+        Let the registry have a new version of an image.
+
+        :param ref: The image reference (with its tag).
+        :param digest: The digest of the new version.
+        """
+
+        with fake_state.locked_state() as state:
+            state.setdefault('registry', dict())[ref] = digest
+
+    def requests(self):
+        """
+        :return: The list of requests the registry got so far.
+        """
+
+        try:
+            with open(self.log) as log_file:
+                return log_file.read().splitlines()
+        except IOError:
+            return []
+
+
+def plan_local_image_chain(env):
+    """
+    A local image built on another local image, used by two containers. If
+    the build context of the base image changes, check mode has to plan the
+    same as a real run does: building both images and recreating both
+    containers.
+    """
+
+    base = os.path.join(env.dir, 'base')
+    app = os.path.join(env.dir, 'app')
+    write_file(os.path.join(base, 'Dockerfile'), 'FROM scratch\nCOPY . /\n')
+    write_file(os.path.join(base, 'file.txt'), 'first\n')
+    write_file(os.path.join(app, 'Dockerfile'), 'FROM base:local\nCOPY . /\n')
+    args = dict(containers=[dict(name='base', image='base', path=base, state='built'),
+                            dict(name='app1', image='app', path=app),
+                            dict(name='app2', image='app', path=app)],
+                state='running', parallel=2)
+    result = env.task(args)
+    expect(not result.get('failed'), 'The first run failed: %s', result.get('msg'))
+
+    write_file(os.path.join(base, 'file.txt'), 'second\n')
+    planned = env.task(dict(args, _ansible_check_mode=True))
+    expect(not planned.get('failed'), 'Check mode failed: %s', planned.get('msg'))
+    done = env.task(args)
+    expect(not done.get('failed'), 'The second run failed: %s', done.get('msg'))
+
+    expected = dict(base=['build'], app1=['build', 'recreate'], app2=['recreate'])
+    for plan_result, result in zip(planned['results'], done['results']):
+        name = result['name']
+        plan = [step['action'] for step in plan_result.get('plan', [])]
+        expect(plan == expected[name], 'Check mode planned %s for %s instead of %s', plan, name, expected[name])
+        expect(actions(result) == plan, 'Check mode planned %s for %s, but it did %s', plan, name, actions(result))
+
+
+def pull_check_digest(env):
+    """
+    With 'pull_check: digest', the registry is asked for the digest of the
+    tag (with a token, like Docker Hub wants it), and the image is pulled
+    and the container recreated only once the registry has a new version.
+    Within 'pull_check_ttl', the cached digest is used.
+    """
+
+    registry = FakeRegistry(env)
+    try:
+        image = registry.host + '/app:stable'
+        registry.push(image, 'sha256:' + '1' * 64)
+        args = dict(name='app', image=image, state='running', pull_check='digest', pull_check_ttl=0)
+        result = env.task(args)
+        expect("Executed 'docker pull'" in result.get('change_reason', []), 'The image was not pulled: %s', result)
+
+        result = env.task(args)
+        expect(not result['changed'], 'The container changed without a new version: %s', result)
+        requests = registry.requests()
+        expect([request.split(' ')[0] for request in requests] == ['HEAD', 'GET', 'HEAD'],
+               'Expected a challenge, a token and the manifest, the registry got %s', requests)
+
+        registry.push(image, 'sha256:' + '2' * 64)
+        result = env.task(args)
+        expect("Newer image available in the registry: sha256:" + '2' * 64 in result['change_reason'] and
+               actions(result) == ['recreate'], 'The new version was not pulled and run: %s', result)
+
+        result = env.task(args)
+        expect(not result['changed'], 'The container changed again: %s', result)
+
+        registry.push(image, 'sha256:' + '3' * 64)
+        count = len(registry.requests())
+        result = env.task(dict(args, pull_check_ttl=600))
+        expect(not result['changed'] and len(registry.requests()) == count,
+               'The cached digest was not used: %s', result)
+    finally:
+        registry.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--check', action='append', choices=CHECKS,
+                        help='Run only this check (can be given more than once)')
+    parser.add_argument('--backend', action='append', choices=BACKENDS,
+                        help='Use only this backend (can be given more than once)')
+    parser.add_argument('--work-dir', default=None, help='Where to create the fakes and build contexts')
+    options = parser.parse_args()
+
+    failed = 0
+    for check in options.check or CHECKS:
+        for backend in options.backend or BACKENDS:
+            env = Environment(options.work_dir, backend, 0.0, 0.0)
+            try:
+                globals()[check](env)
+                sys.stdout.write('%s (%s): ok\n' % (check, backend))
+            except CheckFailed as e:
+                failed += 1
+                sys.stdout.write('%s (%s): FAILED: %s\n' % (check, backend, e))
+            except Exception:
+                failed += 1
+                sys.stdout.write('%s (%s): ERROR\n%s' % (check, backend, traceback.format_exc()))
+            finally:
+                env.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -22,6 +22,7 @@ pulled/built if needed. The module arguments translate 1:1 to command line
 arguments for the 'docker run' command, with a few exceptions:
 
 state: running   - The container image is up to date and the container is running
+                   (changed resource limits are applied with 'docker update')
        restarted - The container image is up to date and the container is started
                    (restarted if it was already running)
        stopped   - The container is not running
@@ -40,51 +41,2360 @@ image: Name of the image. You must not include a tag if you build a local image
 
 command: The command to run inside the container.
 
-Only 'state' and 'name' are always required. 'image' is not required if 'state'
-equals 'stopped', otherwise it is required as well. For the other arguments,
-limitations of the 'docker' command may apply.
+output_lines: How many of the last lines of the output of 'docker build',
+              'docker pull' and 'docker run' are kept (default 100).
+
+output_log: Write the complete output of those commands to a log file in
+            /var/local/ansible/docker_simple/.logs (rotated at 10MB).
+
+pull_check: 'exists' (the default) pulls an image only if it doesn't exist
+            locally, 'digest' also pulls it if the registry has a different
+            version of it. The digests from the registry are cached for
+            'pull_check_ttl' seconds (default 600).
+
+replace_strategy: 'stop_first' (the default) stops the old container before
+                  the new one is started. With 'start_first', the new one is
+                  started under a temporary name first and the old one is
+                  only replaced once the new one is running (healthy, if it
+                  has a health check). Containers that publish fixed host
+                  ports or have a fixed address fall back to 'stop_first'.
+
+build_cache: Build local images with 'docker buildx build' (BuildKit) and
+             keep their layer cache in this directory, in a directory per
+             image ('--cache-to/--cache-from type=local'). The directory can
+             be shared between hosts, so a fresh host builds from the cache.
+
+keep_images: Remove the images previously built for the container after a
+             build, except for the last 'keep_images' (the current one
+             included). By default, no image is removed. The freed space
+             (of the layers no other image uses) is reported in
+             'reclaimed_bytes'.
+
+reload_on: Files or directories on the host (e.g. bind mounted configuration).
+           If only their content changed, the running container is reloaded
+           instead of recreated: 'reload_command' is executed in it with
+           'docker exec', or 'reload_signal' (default HUP) is sent to it.
+
+background: Start builds and pulls in the background and return right away
+            (the container is not started yet). A later call for the same
+            image waits for the build/pull instead of starting it again,
+            with 'background' it only reports whether it is still running.
+
+job_timeout: How many seconds to wait at most for a build or pull in the
+             background (default 3600).
+
+wait_for: 'running' or 'healthy', wait until the container is running or its
+          health check passes before returning (for the states 'running'
+          and 'restarted'). The module follows the events of the container
+          instead of polling it and reports the seconds it took from
+          starting the container in 'time_to_ready'.
+
+wait_timeout: How many seconds to wait at most (default 60).
+
+trace: Append how long every phase took (the 'timings' of the result) to
+       /var/local/ansible/docker_simple/.trace.jsonl, in the format of the
+       Chrome trace viewer (one event per line).
+
+containers: A list of containers to manage in one go. Every entry takes the
+            same arguments as the module itself, the arguments given next
+            to 'containers' are used as defaults for all entries. The result
+            contains a list 'results' with the outcome for every container.
+
+backend: How to talk to docker: 'cli' (the docker command), 'api' (the unix
+         socket of the docker daemon) or 'auto' (the default, the socket if
+         the daemon is reachable over it).
+
+fact_cache: Cache what docker knows about all containers and images on the
+            host for this many seconds (default 0, no cache), so the tasks
+            that follow each other don't have to inspect them again. The
+            cache is dropped as soon as the module changes something, or if
+            docker reports that a container or image changed since.
+
+parallel: How many of the 'containers' may be handled at the same time
+          (default 1). Containers are started after the containers they
+          depend on ('link', 'volumes_from', 'network: container:<name>')
+          and stopped before them. Every image is built or pulled once
+          before that, local images after the local images they are built
+          on ('FROM <image>:local').
+
+In check mode, nothing is changed. The result contains a 'plan' with the
+actions the module would take (build, pull, run, recreate, update, start,
+restart, reload, stop, remove) and the reasons for them.
+
+Only 'state' and 'name' (or 'containers') are always required. 'image' is not
+required if 'state' equals 'stopped', otherwise it is required as well. For the
+other arguments, limitations of the 'docker' command may apply.
 
 Note that module arguments are translated to the long names of the command line
 arguments and that you have to substitute a '-' in the middle of the argument
 name with a '_'.
 
-ALL docker command line arguments are supported, with the exception of some
-useless ones for ansible (--interactive for example). If an argument is not
-supported, it is most likely very new or got simply overlooked. Or it is not
-documented in the official manpage.
-"""
+ALL docker command line arguments are supported, with the exception of some
+useless ones for ansible (--interactive for example). If an argument is not
+supported, it is most likely very new or got simply overlooked. Or it is not
+documented in the official manpage.
+"""
+
+import os
+import re
+import errno
+import shutil
+import fcntl
+import json
+import collections
+import stat
+import time
+import hashlib
+import tempfile
+import socket
+import threading
+import contextlib
+from subprocess import check_output as exec_command
+from subprocess import CalledProcessError
+from subprocess import Popen
+from subprocess import PIPE
+from subprocess import STDOUT
+from subprocess import DEVNULL
+from urllib.parse import quote as url_quote
+from urllib.parse import urlencode as url_encode
+from ansible.module_utils.basic import AnsibleModule
+
+# Ansible starts a new interpreter for every task, so modules that are only
+# needed by some tasks (thread pools, registry requests, ...) are imported
+# where they are used. See bench/import_time.py.
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCKER_COMMANDS_PATH = '/var/local/ansible/docker_simple'
+
+# The state of all containers is stored in this file. Container names can't
+# start with a dot, so this can't clash with the files older versions used.
+STATE_FILE = '.state.json'
+STATE_LOCK_FILE = '.state.lock'
+
+# The fingerprint indexes of the build contexts live in a hidden directory next
+# to the files with the previous commands. Container names can't start with a
+# dot, so this can never clash with one of those files.
+FINGERPRINTS_DIR = '.fingerprints'
+
+# The complete output of the docker commands is logged in this directory
+LOGS_DIR = '.logs'
+
+# Builds and pulls running in the background are tracked in this directory
+JOBS_DIR = '.jobs'
+
+# The timings of all phases are appended to this file (see 'trace')
+TRACE_FILE = '.trace.jsonl'
+
+# The digests of the images in their registries are cached in this file
+REGISTRY_DIGESTS_FILE = '.registry_digests.json'
+
+# All containers and images on the host are cached in this file (see
+# 'fact_cache')
+FACT_CACHE_FILE = '.facts.json'
+
+# How many directories of a build context are listed at the same time when
+# it's compared to the creation time of an image (see DockerIgnore.newer_file)
+CONTEXT_SCAN_THREADS = 8
+
+# The states a container can be put into
+STATES = ['running', 'stopped', 'restarted', 'built']
+
+# Run arguments that can be changed on an existing container ('docker update')
+UPDATABLE_ARGS = frozenset(['blkio_weight', 'cpu_period', 'cpu_quota', 'cpu_rt_period', 'cpu_rt_runtime',
+                            'cpu_shares', 'cpus', 'cpuset_cpus', 'cpuset_mems', 'kernel_memory', 'memory',
+                            'memory_reservation', 'memory_swap', 'pids_limit', 'restart'])
+
+# Module arguments that apply to the module execution as a whole and not to
+# a single container
+GLOBAL_ARGS = ('containers', 'parallel', 'backend', 'fact_cache')
+
+# Locally built images are labeled with what they were built from, so their
+# freshness can be checked even without the stored state.
+CONTEXT_DIGEST_LABEL = 'docker_simple.context_digest'
+BUILD_COMMAND_LABEL = 'docker_simple.build_command'
+
+
+def fail(module, msg, **kwargs):
+    """
+    Notify ansible that the module execution failed.
+
+    :param module: Interface to ansible.
+    :param msg: The error message to display.
+    :param kwargs: Additional values to return to ansible.
+    :return: A dict indicating that something changed.
+    """
+
+    module.fail_json(msg=msg, changed=True, **kwargs)
+    return dict(changed=True)
+
+
+def normalize_image_ref(ref):
+    """
+    Bring an image reference into the form docker uses in the 'RepoTags' and
+    'RepoDigests' of an image (e.g. 'docker.io/library/debian' -> 'debian:latest').
+
+    :param ref: The image reference.
+    :return: The normalized image reference.
+    """
+
+    if '@' not in ref and ':' not in ref.rsplit('/', 1)[-1]:
+        ref += ':latest'
+    for prefix in ('docker.io/', 'index.docker.io/'):
+        if ref.startswith(prefix):
+            ref = ref[len(prefix):]
+    if ref.startswith('library/'):
+        ref = ref[len('library/'):]
+    return ref
+
+
+def dockerfile_base_images(path):
+    """
+    Get the images a Dockerfile builds on: the ones in its FROM lines and
+    the ones it copies files from ('COPY --from'). Build stages, 'scratch'
+    and references that use build arguments are left out.
+
+    :param path: The path to the Dockerfile.
+    :return: A list with the normalized references of the images.
+    """
+
+    try:
+        with open(path) as dockerfile:
+            text = dockerfile.read()
+    except (IOError, OSError):
+        # Docker will tell the user when it tries to build
+        return []
+
+    # Instructions can be continued on the next line
+    text = re.sub(r'\\[ \t]*\r?\n', ' ', text)
+
+    stages = set()
+    images = []
+    for line in text.splitlines():
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        instruction = words[0].upper()
+        if instruction == 'FROM':
+            args = [word for word in words[1:] if not word.startswith('--')]
+            refs = args[:1]
+        elif instruction == 'COPY':
+            args = []
+            refs = [word[len('--from='):] for word in words[1:] if word.lower().startswith('--from=')]
+        else:
+            continue
+
+        for ref in refs:
+            if '$' in ref or ref.lower() in stages or ref.isdigit() or ref == 'scratch':
+                continue
+            ref = normalize_image_ref(ref)
+            if ref not in images:
+                images.append(ref)
+
+        # 'FROM <image> AS <stage>'
+        if len(args) >= 3 and args[1].lower() == 'as':
+            stages.add(args[2].lower())
+    return images
+
+
+class CommandOutput(object):
+    """
+    Collects the output of a docker command while it runs. Only the last
+    lines are kept in memory (and reported back to ansible), the complete
+    output can be written to a log file that is rotated once it gets big.
+    """
+
+    # Only the start of longer lines is kept, progress bars can get very long
+    MAX_LINE_LENGTH = 4096
+
+    def __init__(self, tail_lines, log_path=None, log_size=10 * 1024 * 1024, log_backups=3):
+        """
+        :param tail_lines: How many of the last lines to keep.
+        :param log_path: The file to write the complete output to, if any.
+        :param log_size: The size at which the log file is rotated.
+        :param log_backups: How many rotated log files to keep.
+        """
+
+        self.tail = collections.deque(maxlen=max(1, tail_lines))
+        self.dropped = 0
+        self.partial = False
+        self.log_path = log_path
+        self.log_size = log_size
+        self.log_backups = log_backups
+        self.log_file = None
+
+    def feed(self, line):
+        """
+        Add a line of output, or a part of it. Only the start of a line goes
+        to the tail, the log file gets all of it.
+
+        :param line: The line, including its line break (without it if the
+                     rest of the line follows).
+        """
+
+        if self.log_path:
+            self.log(line)
+        if self.partial:
+            # The rest of a line whose start we already have
+            if not self.tail[-1].endswith('\n'):
+                self.tail[-1] += '\n'
+        else:
+            if len(self.tail) == self.tail.maxlen:
+                self.dropped += 1
+            self.tail.append(line if len(line) <= self.MAX_LINE_LENGTH else line[:self.MAX_LINE_LENGTH] + '\n')
+        self.partial = not line.endswith('\n')
+
+    def log(self, line):
+        """
+        Write a line to the log file, rotating it if it got too big.
+
+        :param line: The line.
+        """
+
+        if self.log_file is None:
+            log_dir = os.path.dirname(self.log_path)
+            os.makedirs(log_dir, mode=0o700, exist_ok=True)
+            self.log_file = open(self.log_path, 'a')
+        self.log_file.write(line)
+
+        if self.log_file.tell() >= self.log_size:
+            self.log_file.close()
+            for index in range(self.log_backups - 1, 0, -1):
+                if os.path.exists('%s.%d' % (self.log_path, index)):
+                    os.rename('%s.%d' % (self.log_path, index), '%s.%d' % (self.log_path, index + 1))
+            os.rename(self.log_path, self.log_path + '.1')
+            self.log_file = open(self.log_path, 'a')
+
+    def close(self):
+        """
+        Close the log file.
+        """
+
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def text(self):
+        """
+        Get the collected output.
+
+        :return: The last lines of the output.
+        """
+
+        text = ''.join(self.tail)
+        if self.dropped:
+            text = '[%d lines omitted]\n' % self.dropped + text
+        return text
+
+
+class Timings(object):
+    """
+    Measures how long the phases of managing a container take (reading the
+    state, scanning the build context, inspecting, building, ...).
+    """
+
+    def __init__(self, name):
+        """
+        :param name: The name of the container.
+        """
+
+        self.name = name
+        self.started = time.time()
+        self.seconds = collections.OrderedDict()
+        self.events = []
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        """
+        Measure a phase. Phases that happen more than once are added up.
+
+        :param phase: The name of the phase.
+        """
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self.seconds[phase] = self.seconds.get(phase, 0) + duration
+            # The format of the Chrome trace viewer ('complete' events)
+            self.events.append(dict(name=phase, cat='docker_simple', ph='X',
+                                    ts=int(start * 1000000), dur=int(duration * 1000000),
+                                    pid=os.getpid(), tid=threading.current_thread().ident,
+                                    args=dict(container=self.name)))
+
+    def result(self):
+        """
+        Get the timings we report back to ansible.
+
+        :return: A dict mapping every phase to the seconds it took.
+        """
+
+        result = dict((phase, round(seconds, 3)) for phase, seconds in self.seconds.items())
+        result['total'] = round(time.time() - self.started, 3)
+        return result
+
+    def write_trace(self, path):
+        """
+        Append the measured phases to a trace file, one JSON object per line.
+
+        :param path: The path to the file.
+        """
+
+        lines = ''.join(json.dumps(event) + '\n' for event in self.events)
+        with open(path, 'a') as trace_file:
+            # Several containers may be handled at the same time
+            fcntl.flock(trace_file, fcntl.LOCK_EX)
+            trace_file.write(lines)
+        self.events = []
+
+
+def stream_command(command, output, cwd=None):
+    """
+    Execute a command and collect its output while it runs, so that we
+    never have to keep all of it in memory.
+
+    :param command: The command.
+    :param output: A CommandOutput to collect the output in.
+    :param cwd: The directory to run the command in.
+    :return: The collected output.
+    :raises CalledProcessError: If the command fails (with the collected
+                                output).
+    """
+
+    if output.log_path:
+        output.log('$ ' + ' '.join(command) + '\n')
+
+    process = Popen(command, cwd=cwd, stdout=PIPE, stderr=STDOUT)
+    try:
+        # Reading with a limit keeps a single huge line from being read at
+        # once, the rest of it is fed in parts (see CommandOutput.feed())
+        for line in iter(lambda: process.stdout.readline(CommandOutput.MAX_LINE_LENGTH), b''):
+            output.feed(line.decode('utf-8', 'replace'))
+        returncode = process.wait()
+    finally:
+        process.stdout.close()
+        output.close()
+
+    if returncode != 0:
+        raise CalledProcessError(returncode, command, output.text())
+    return output.text()
+
+
+class DockerCli(object):
+    """
+    Executes docker operations by calling the 'docker' command.
+    """
+
+    def inspect(self, object_type, refs):
+        """
+        Inspect a list of docker objects of the same type with one command.
+
+        :param object_type: 'container', 'image' or None for objects of
+                            both types.
+        :param refs: The names/references of the objects.
+        :return: A list with the information about the objects that exist.
+        """
+
+        refs = sorted(set(ref for ref in refs if ref))
+        if not refs:
+            return []
+
+        # 'docker inspect' fails if one of the objects doesn't exist, but it
+        # still prints the ones it found, so we don't care about the exit code.
+        type_args = ['--type', object_type] if object_type else []
+        process = Popen(['docker', 'inspect'] + type_args + refs,
+                        stdout=PIPE, stderr=PIPE, universal_newlines=True)
+        stdout, _ = process.communicate()
+        try:
+            return json.loads(stdout) or []
+        except ValueError:
+            return []
+
+    def inventory(self):
+        """
+        Inspect all containers and (tagged) images on the host, with a
+        single 'docker inspect' for all of them.
+
+        :return: A tuple with the lists of the inspect results of the
+                 containers and of the images.
+        """
+
+        containers = exec_command(['docker', 'ps', '--all', '--quiet', '--no-trunc'], universal_newlines=True)
+        images = exec_command(['docker', 'images', '--quiet', '--no-trunc'], universal_newlines=True)
+        found = self.inspect(None, containers.split() + images.split())
+        # Only containers have a state
+        return [info for info in found if 'State' in info], [info for info in found if 'State' not in info]
+
+    def events_between(self, since, until):
+        """
+        Get the events of all containers and images in a period of time.
+
+        :param since: The start of the period (seconds since the epoch).
+        :param until: The end of the period.
+        :return: A list of the events (dicts, as the API reports them).
+        """
+
+        output = exec_command(['docker', 'events', '--since', '%.6f' % since, '--until', '%.6f' % until,
+                               '--filter', 'type=container', '--filter', 'type=image', '--format', '{{json .}}'],
+                              universal_newlines=True)
+        return [json.loads(line) for line in output.splitlines() if line.strip()]
+
+    def run(self, command, spec, output):
+        """
+        Create and start a container.
+
+        :param command: The 'docker run' command.
+        :param spec: The same as a dict, see Container.run_spec.
+        :param output: A CommandOutput to collect the output in.
+        :return: The output of the command.
+        """
+
+        return stream_command(command, output)
+
+    def start(self, name):
+        """
+        Start an existing container.
+
+        :param name: The name of the container.
+        """
+
+        exec_command(['docker', 'start', name], stderr=STDOUT, universal_newlines=True)
+
+    def restart(self, name):
+        """
+        Restart a container.
+
+        :param name: The name of the container.
+        """
+
+        exec_command(['docker', 'restart', name], stderr=STDOUT, universal_newlines=True)
+
+    def stop(self, name):
+        """
+        Stop a container.
+
+        :param name: The name of the container.
+        """
+
+        exec_command(['docker', 'stop', name], stderr=STDOUT, universal_newlines=True)
+
+    def update(self, name, updates):
+        """
+        Change resource limits or the restart policy of a container.
+
+        :param name: The name of the container.
+        :param updates: A dict with the changed run arguments (see
+                        UPDATABLE_ARGS).
+        """
+
+        command = Container._construct_docker_command('update', **updates)
+        command.append(name)
+        exec_command(command, stderr=STDOUT, universal_newlines=True)
+
+    def remove(self, name):
+        """
+        Remove a container.
+
+        :param name: The name of the container.
+        """
+
+        exec_command(['docker', 'rm', name], stderr=STDOUT, universal_newlines=True)
+
+    def remove_image(self, image_id):
+        """
+        Remove an image (and its untagged parents, e.g. the intermediate
+        images of a build).
+
+        :param image_id: The ID of the image.
+        """
+
+        exec_command(['docker', 'rmi', image_id], stderr=STDOUT, universal_newlines=True)
+
+    def image_history(self, image_id):
+        """
+        Get the sizes of the steps an image was built with.
+
+        :param image_id: The ID of the image.
+        :return: A list with the size of the layer every step added, oldest
+                 first (0 for steps that didn't add a layer).
+        """
+
+        output = exec_command(['docker', 'image', 'history', '--no-trunc', '--human=false', '--format', '{{.Size}}',
+                               image_id], universal_newlines=True)
+        return [int(size) for size in reversed(output.split())]
+
+    def image_layers(self):
+        """
+        Get the layers of all images on the host.
+
+        :return: A list with the layers of every image, lowest first.
+        """
+
+        images = exec_command(['docker', 'images', '--quiet', '--no-trunc'], universal_newlines=True)
+        return [(info.get('RootFS') or dict()).get('Layers') or [] for info in self.inspect('image', images.split())]
+
+    def rename(self, name, new_name):
+        """
+        Rename a container.
+
+        :param name: The name of the container.
+        :param new_name: Its new name.
+        """
+
+        exec_command(['docker', 'rename', name, new_name], stderr=STDOUT, universal_newlines=True)
+
+    def kill(self, name, signal):
+        """
+        Send a signal to the main process of a container.
+
+        :param name: The name of the container.
+        :param signal: The signal (e.g. 'HUP').
+        """
+
+        exec_command(['docker', 'kill', '--signal', signal, name], stderr=STDOUT, universal_newlines=True)
+
+    def exec_in(self, name, command):
+        """
+        Run a command in a running container.
+
+        :param name: The name of the container.
+        :param command: The command (a list).
+        :return: The output of the command.
+        """
+
+        return exec_command(['docker', 'exec', name] + command, stderr=STDOUT, universal_newlines=True)
+
+    def wait(self, name, condition, timeout):
+        """
+        Wait until a container is running or healthy. Instead of polling its
+        state, we follow the events of the container.
+
+        :param name: The name of the container.
+        :param condition: 'running' or 'healthy'.
+        :param timeout: How many seconds to wait at most.
+        :raises ContainerNotReady: If the container exits or isn't ready in
+                                   time.
+        """
+
+        deadline = time.time() + timeout
+
+        # The events are replayed from here on, so whatever happens between
+        # inspecting the container and subscribing to its events isn't lost.
+        since = time.time()
+        found = self.inspect('container', [name])
+        if not found:
+            raise ContainerNotReady(name, condition, "the container doesn't exist")
+        state = found[0]['State']
+        if not state.get('Running') and not state.get('Restarting'):
+            raise ContainerNotReady(name, condition, 'the container exited with code %s' % state.get('ExitCode'))
+        if condition == 'healthy' and not state.get('Health'):
+            raise ContainerNotReady(name, condition, 'the container has no health check')
+        if condition == 'running' and state.get('Running'):
+            return
+        if condition == 'healthy' and state['Health'].get('Status') == 'healthy':
+            return
+
+        # With a restart policy, docker starts the container again if it dies
+        restart_policy = (found[0].get('HostConfig') or dict()).get('RestartPolicy') or dict()
+        restarts = restart_policy.get('Name') not in (None, '', 'no')
+        status = state['Health'].get('Status') if condition == 'healthy' else state.get('Status')
+
+        for event in self.events(name, since, deadline):
+            action = event.get('Action') or event.get('status') or ''
+            if action.startswith('health_status:'):
+                status = action.split(':', 1)[1].strip()
+                if condition == 'healthy' and status == 'healthy':
+                    return
+            elif action == 'start':
+                status = 'running' if condition == 'running' else 'starting'
+                if condition == 'running':
+                    return
+            elif action in ('die', 'destroy'):
+                status = 'exited'
+                if action == 'destroy' or not restarts:
+                    exit_code = ((event.get('Actor') or dict()).get('Attributes') or dict()).get('exitCode', '?')
+                    raise ContainerNotReady(name, condition, 'the container exited with code %s' % exit_code)
+        raise ContainerNotReady(name, condition, 'timed out after %s seconds (last status: %s)' % (timeout, status))
+
+    def events(self, name, since, deadline):
+        """
+        Follow the events of a container.
+
+        :param name: The name of the container.
+        :param since: The time from which on the events are reported.
+        :param deadline: The time at which we stop following the events.
+        :return: A generator of the events (dicts, as the API reports them).
+        """
+
+        command = ['docker', 'events', '--since', '%.6f' % since, '--filter', 'type=container',
+                   '--filter', 'container=' + name, '--format', '{{json .}}']
+        process = Popen(command, stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+
+        # 'docker events' runs until it's killed
+        timer = threading.Timer(max(0, deadline - time.time()), process.kill)
+        timer.start()
+        try:
+            for line in process.stdout:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        finally:
+            timer.cancel()
+            process.kill()
+            process.wait()
+            process.stdout.close()
+
+    def build(self, command, path, output):
+        """
+        Build an image.
+
+        :param command: The 'docker build' command.
+        :param path: The directory to run the command in.
+        :param output: A CommandOutput to collect the output in.
+        :return: The output of the command.
+        """
+
+        return stream_command(command, output, cwd=path)
+
+    def pull(self, image, output):
+        """
+        Pull an image from the registry.
+
+        :param image: The image reference.
+        :param output: A CommandOutput to collect the output in.
+        :return: The output of the command.
+        """
+
+        return stream_command(['docker', 'pull', image], output)
+
+
+class DockerApiError(CalledProcessError):
+    """
+    Raised if the docker daemon returns an error. It's a CalledProcessError,
+    so it's handled the same as a failing docker command.
+    """
+
+    def __init__(self, status, method, path, message):
+        CalledProcessError.__init__(self, status, ['docker-api', method, path], message)
+
+
+class ContainerNotReady(CalledProcessError):
+    """
+    Raised if a container doesn't get running or healthy (see 'wait_for').
+    It's a CalledProcessError, so it's handled the same as a failing docker
+    command.
+    """
+
+    def __init__(self, name, condition, reason):
+        CalledProcessError.__init__(self, 1, ['docker', 'events', '--filter', 'container=' + name],
+                                    "Container '%s' did not become %s: %s" % (name, condition, reason))
+
+
+# Defined by unix_http_connection()
+UnixHTTPConnection = None
+
+
+def unix_http_connection(socket_path, timeout=None):
+    """
+    Open a HTTP connection over a unix socket. The connection class is only
+    defined here, so http.client is not imported by tasks that use the
+    'docker' command.
+
+    :param socket_path: The path to the unix socket.
+    :param timeout: The timeout of the socket in seconds (None for none).
+    :return: A UnixHTTPConnection.
+    """
+
+    global UnixHTTPConnection
+    if UnixHTTPConnection is None:
+        import http.client as http_client
+
+        class UnixHTTPConnection(http_client.HTTPConnection):
+            """
+            A HTTP connection over a unix socket.
+            """
+
+            def __init__(self, socket_path, timeout=None):
+                # We don't set a timeout by default, stopping a container can take a while
+                http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+                self.socket_path = socket_path
+
+            def connect(self):
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(self.socket_path)
+
+    return UnixHTTPConnection(socket_path, timeout=timeout)
+
+
+class DockerApi(DockerCli):
+    """
+    Executes docker operations by talking to the docker daemon directly over
+    its unix socket, which saves us from starting the 'docker' command for
+    every operation. The connection is kept open for all requests (one per
+    thread). Everything the API can't do the same way as the command line
+    (builds, pulls, 'docker exec', some 'docker run' arguments) is done by
+    the 'docker' command as before.
+    """
+
+    class UnsupportedArgument(Exception):
+        """
+        Raised if a 'docker run' argument can't be translated to the API.
+        """
+
+        pass
+
+    def __init__(self, socket_path):
+        """
+        :param socket_path: The path to the unix socket of the docker daemon.
+        """
+
+        self.socket_path = socket_path
+        self.local = threading.local()
+
+    def request(self, method, path, query=None, body=None):
+        """
+        Send a request to the docker daemon.
+
+        :param method: The HTTP method.
+        :param path: The path of the API endpoint.
+        :param query: A dict with the query parameters.
+        :param body: The body of the request, will be sent as JSON.
+        :return: A tuple with the status and the (decoded) response.
+        """
+
+        url = url_quote(path, safe='/:@')
+        if query:
+            url += '?' + url_encode(query)
+        headers = dict()
+        if body is not None:
+            body = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+
+        import http.client as http_client
+
+        connection = getattr(self.local, 'connection', None)
+        while True:
+            reused = connection is not None
+            if not reused:
+                connection = self.local.connection = unix_http_connection(self.socket_path)
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http_client.HTTPException, socket.error):
+                connection.close()
+                connection = self.local.connection = None
+                # The daemon may close idle connections, so we try again once
+                # with a new one. A fresh connection failing is a real error.
+                if not reused:
+                    raise
+
+        if data and response.getheader('Content-Type', '').startswith('application/json'):
+            data = json.loads(data.decode('utf-8'))
+        return response.status, data
+
+    def call(self, method, path, query=None, body=None):
+        """
+        Send a request to the docker daemon and raise an error if it fails.
+
+        :param method: The HTTP method.
+        :param path: The path of the API endpoint.
+        :param query: A dict with the query parameters.
+        :param body: The body of the request, will be sent as JSON.
+        :return: The (decoded) response.
+        """
+
+        status, data = self.request(method, path, query, body)
+        if status >= 400:
+            raise DockerApiError(status, method, path, self.error_message(data))
+        return data
+
+    @staticmethod
+    def error_message(data):
+        """
+        Get the error message out of the response of the docker daemon.
+
+        :param data: The (decoded) response.
+        :return: The error message.
+        """
+
+        if isinstance(data, dict):
+            return data.get('message', '')
+        return data.decode('utf-8', 'replace')
+
+    def ping(self):
+        """
+        Check, whether we can talk to the docker daemon.
+
+        :return: True if the daemon answers, False otherwise.
+        """
+
+        import http.client as http_client
+
+        try:
+            return self.request('GET', '/_ping')[0] == 200
+        except (http_client.HTTPException, socket.error):
+            return False
+
+    def inspect(self, object_type, refs):
+        results = []
+        for ref in sorted(set(ref for ref in refs if ref)):
+            status, data = self.request('GET', '/%ss/%s/json' % (object_type, ref))
+            if status == 200:
+                results.append(data)
+            elif status != 404:
+                raise DockerApiError(status, 'GET', '/%ss/%s/json' % (object_type, ref), self.error_message(data))
+        return results
+
+    def inventory(self):
+        containers = self.call('GET', '/containers/json', dict(all=1))
+        images = self.call('GET', '/images/json')
+        return (self.inspect('container', [info['Id'] for info in containers]),
+                self.inspect('image', [info['Id'] for info in images]))
+
+    def events_between(self, since, until):
+        # The events are streamed, so the response is read line by line
+        connection = unix_http_connection(self.socket_path, timeout=60)
+        try:
+            query = dict(since='%.6f' % since, until='%.6f' % until,
+                         filters=json.dumps(dict(type=['container', 'image'])))
+            connection.request('GET', '/events?' + url_encode(query))
+            response = connection.getresponse()
+            data = response.read()
+            if response.status >= 400:
+                raise DockerApiError(response.status, 'GET', '/events', self.error_message(data))
+            return [json.loads(line) for line in data.decode('utf-8').splitlines() if line.strip()]
+        finally:
+            connection.close()
+
+    def run(self, command, spec, output):
+        # Attaching to a container in the foreground is left to the command
+        if spec['foreground']:
+            return DockerCli.run(self, command, spec, output)
+        try:
+            config = self.container_config(spec)
+        except DockerApi.UnsupportedArgument:
+            return DockerCli.run(self, command, spec, output)
+
+        status, data = self.request('POST', '/containers/create', dict(name=spec['name']), config)
+        if status == 404:
+            # The image doesn't exist, 'docker run' pulls it for us
+            return DockerCli.run(self, command, spec, output)
+        if status >= 400:
+            raise DockerApiError(status, 'POST', '/containers/create', self.error_message(data))
+        self.call('POST', '/containers/%s/start' % data['Id'])
+        return data['Id'] + '\n'
+
+    def start(self, name):
+        self.call('POST', '/containers/%s/start' % name)
+
+    def restart(self, name):
+        self.call('POST', '/containers/%s/restart' % name)
+
+    def stop(self, name):
+        self.call('POST', '/containers/%s/stop' % name)
+
+    def remove(self, name):
+        self.call('DELETE', '/containers/%s' % name)
+
+    def remove_image(self, image_id):
+        self.call('DELETE', '/images/%s' % image_id)
+
+    def image_history(self, image_id):
+        return [step.get('Size') or 0 for step in reversed(self.call('GET', '/images/%s/history' % image_id))]
+
+    def image_layers(self):
+        images = self.call('GET', '/images/json')
+        return [(info.get('RootFS') or dict()).get('Layers') or []
+                for info in self.inspect('image', [image['Id'] for image in images])]
+
+    def rename(self, name, new_name):
+        self.call('POST', '/containers/%s/rename' % name, dict(name=new_name))
+
+    def kill(self, name, signal):
+        self.call('POST', '/containers/%s/kill' % name, dict(signal=signal))
+
+    def events(self, name, since, deadline):
+        # The stream never ends, so it gets a connection of its own
+        connection = unix_http_connection(self.socket_path, timeout=max(0.001, deadline - time.time()))
+        try:
+            query = dict(since='%.6f' % since, filters=json.dumps(dict(type=['container'], container=[name])))
+            connection.request('GET', '/events?' + url_encode(query))
+            response = connection.getresponse()
+            if response.status >= 400:
+                raise DockerApiError(response.status, 'GET', '/events', self.error_message(response.read()))
+            while True:
+                connection.sock.settimeout(max(0.001, deadline - time.time()))
+                try:
+                    line = response.readline()
+                except socket.timeout:
+                    return
+                if not line:
+                    return
+                try:
+                    yield json.loads(line.decode('utf-8'))
+                except ValueError:
+                    continue
+        finally:
+            connection.close()
+
+    def update(self, name, updates):
+        # The body of the request is a subset of the host config
+        config = self.container_config(dict(image=None, command=None, args=updates))
+        self.call('POST', '/containers/%s/update' % name, body=config['HostConfig'])
+
+    @staticmethod
+    def container_config(spec):
+        """
+        Translate the arguments of 'docker run' to the body of a 'create
+        container' request, the same way the 'docker' command does it.
+
+        :param spec: The arguments, see Container.run_spec.
+        :return: The body of the request.
+        :raises UnsupportedArgument: If an argument can't be translated.
+        """
+
+        args = dict((key, value) for key, value in spec['args'].items() if value)
+        config = dict(Image=spec['image'])
+        host_config = dict()
+        config['HostConfig'] = host_config
+        if spec['command']:
+            config['Cmd'] = spec['command']
+
+        def split_pairs(values):
+            return dict((value.split('=', 1) + [''])[:2] for value in values)
+
+        # Arguments that are passed on as they are
+        plain = dict(hostname=(config, 'Hostname'), user=(config, 'User'), workdir=(config, 'WorkingDir'),
+                     stop_signal=(config, 'StopSignal'), mac_address=(config, 'MacAddress'),
+                     add_host=(host_config, 'ExtraHosts'), blkio_weight=(host_config, 'BlkioWeight'),
+                     cpu_shares=(host_config, 'CpuShares'), cap_add=(host_config, 'CapAdd'),
+                     cap_drop=(host_config, 'CapDrop'), cgroup_parent=(host_config, 'CgroupParent'),
+                     cpu_count=(host_config, 'CpuCount'), cpu_percent=(host_config, 'CpuPercent'),
+                     cpu_period=(host_config, 'CpuPeriod'), cpu_quota=(host_config, 'CpuQuota'),
+                     cpu_rt_period=(host_config, 'CpuRealtimePeriod'),
+                     cpu_rt_runtime=(host_config, 'CpuRealtimeRuntime'),
+                     cpuset_cpus=(host_config, 'CpusetCpus'), cpuset_mems=(host_config, 'CpusetMems'),
+                     device_cgroup_rule=(host_config, 'DeviceCgroupRules'), dns=(host_config, 'Dns'),
+                     dns_option=(host_config, 'DnsOptions'), dns_search=(host_config, 'DnsSearch'),
+                     group_add=(host_config, 'GroupAdd'), ipc=(host_config, 'IpcMode'),
+                     isolation=(host_config, 'Isolation'), network=(host_config, 'NetworkMode'),
+                     pid=(host_config, 'PidMode'), userns=(host_config, 'UsernsMode'), uts=(host_config, 'UTSMode'),
+                     privileged=(host_config, 'Privileged'), read_only=(host_config, 'ReadonlyRootfs'),
+                     rm=(host_config, 'AutoRemove'), security_opt=(host_config, 'SecurityOpt'),
+                     volume_driver=(host_config, 'VolumeDriver'), volumes_from=(host_config, 'VolumesFrom'))
+        # Arguments that ansible gives us as strings, but the API wants numbers
+        numbers = dict(stop_timeout=(config, 'StopTimeout'), oom_score_adj=(host_config, 'OomScoreAdj'),
+                       pids_limit=(host_config, 'PidsLimit'), memory_swappiness=(host_config, 'MemorySwappiness'))
+        sizes = dict(memory='Memory', memory_reservation='MemoryReservation', memory_swap='MemorySwap',
+                     kernel_memory='KernelMemory', shm_size='ShmSize')
+
+        for key, value in args.items():
+            if key in ('name', 'command', 'foreground'):
+                continue
+            elif key in plain:
+                target, field = plain[key]
+                target[field] = value
+            elif key in numbers:
+                target, field = numbers[key]
+                target[field] = int(value)
+            elif key in sizes:
+                host_config[sizes[key]] = parse_bytes(value)
+            elif key == 'cpus':
+                host_config['NanoCpus'] = int(float(value) * 1000000000)
+            elif key == 'env':
+                # Variables without a value are taken from the environment of
+                # the 'docker' command, so we leave that to the command.
+                if any('=' not in variable for variable in value):
+                    raise DockerApi.UnsupportedArgument(key)
+                config['Env'] = value
+            elif key == 'entrypoint':
+                # The last one wins on the command line
+                config['Entrypoint'] = [value[-1]]
+            elif key == 'label':
+                config['Labels'] = split_pairs(value)
+            elif key == 'expose':
+                config.setdefault('ExposedPorts', dict()).update(
+                    (port if '/' in port else port + '/tcp', dict()) for port in map(str, value))
+            elif key == 'publish':
+                for port in value:
+                    container_port, binding = parse_port(port)
+                    config.setdefault('ExposedPorts', dict())[container_port] = dict()
+                    host_config.setdefault('PortBindings', dict()).setdefault(container_port, []).append(binding)
+            elif key == 'link':
+                host_config['Links'] = [link if ':' in link else link + ':' + link for link in value]
+            elif key == 'log_driver':
+                host_config.setdefault('LogConfig', dict(Config=dict()))['Type'] = value
+            elif key == 'log_opt':
+                host_config.setdefault('LogConfig', dict(Config=dict()))['Config'] = split_pairs(value)
+            elif key == 'restart':
+                policy = value.split(':')
+                host_config['RestartPolicy'] = dict(Name=policy[0])
+                if len(policy) > 1:
+                    host_config['RestartPolicy']['MaximumRetryCount'] = int(policy[1])
+            elif key == 'storage_opt':
+                host_config['StorageOpt'] = split_pairs(value)
+            elif key == 'sysctl':
+                host_config['Sysctls'] = split_pairs([value])
+            elif key == 'tmpfs':
+                host_config['Tmpfs'] = dict((mount.split(':', 1) + [''])[:2] for mount in value)
+            elif key == 'ulimit':
+                host_config['Ulimits'] = []
+                for ulimit in value:
+                    name, limits = ulimit.split('=', 1)
+                    limits = limits.split(':')
+                    host_config['Ulimits'].append(dict(Name=name, Soft=int(limits[0]), Hard=int(limits[-1])))
+            elif key == 'device':
+                host_config['Devices'] = []
+                for device in value:
+                    parts = device.split(':')
+                    host_config['Devices'].append(dict(PathOnHost=parts[0],
+                                                       PathInContainer=parts[1] if len(parts) > 1 else parts[0],
+                                                       CgroupPermissions=parts[2] if len(parts) > 2 else 'rwm'))
+            elif key == 'volume':
+                for volume in value:
+                    if ':' in volume:
+                        host_config.setdefault('Binds', []).append(volume)
+                    else:
+                        config.setdefault('Volumes', dict())[volume] = dict()
+            elif key in ('network_alias', 'ip', 'ip6', 'link_local_ip'):
+                # These are only allowed on user defined networks
+                network = args.get('network')
+                if not network or network in ('bridge', 'host', 'none', 'default') or ':' in network:
+                    raise DockerApi.UnsupportedArgument(key)
+                endpoint = config.setdefault('NetworkingConfig', dict(EndpointsConfig={network: dict()}))
+                endpoint = endpoint['EndpointsConfig'][network]
+                if key == 'network_alias':
+                    endpoint['Aliases'] = value
+                elif key == 'link_local_ip':
+                    endpoint.setdefault('IPAMConfig', dict())['LinkLocalIPs'] = value
+                else:
+                    endpoint.setdefault('IPAMConfig', dict())['IPv4Address' if key == 'ip' else 'IPv6Address'] = value
+            else:
+                # Everything else is either rarely used or the command line
+                # does more than just passing it on (e.g. reading files).
+                raise DockerApi.UnsupportedArgument(key)
+
+        return config
+
+
+def parse_bytes(value):
+    """
+    Convert a size like '512m' to bytes, the way docker does it.
+
+    :param value: The size.
+    :return: The number of bytes.
+    """
+
+    match = re.match(r'^\s*(-?\d+(?:\.\d+)?)\s*([kmgtp]?)i?b?\s*$', str(value), re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: ' + str(value))
+    return int(float(match.group(1)) * 1024 ** ' kmgtp'.index(match.group(2).lower() or ' '))
+
+
+def parse_docker_time(time_str):
+    """
+    Convert a timestamp the way docker formats it
+    ('2019-05-04T12:34:56.123456789Z', always UTC) to an integer.
+
+    :param time_str: The timestamp.
+    :return: The nanoseconds since the epoch.
+    """
+
+    import calendar
+
+    match = re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?', time_str)
+    seconds = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+    fraction = (match.group(2) or '')[:9]
+    return seconds * 1000000000 + int(fraction.ljust(9, '0'))
+
+
+def parse_port(port):
+    """
+    Translate a '--publish' argument to a port binding of the API.
+
+    :param port: The argument ([ip:][host port:]container port[/protocol]).
+    :return: A tuple with the container port and the binding.
+    """
+
+    port = str(port)
+    protocol = 'tcp'
+    if '/' in port:
+        port, protocol = port.rsplit('/', 1)
+
+    # IPv6 addresses are written in brackets
+    host_ip = ''
+    if port.startswith('['):
+        host_ip, port = port[1:].split(']:', 1)
+    parts = port.split(':')
+    if len(parts) == 3:
+        host_ip, parts = parts[0], parts[1:]
+    host_port, container_port = parts if len(parts) == 2 else ('', parts[0])
+
+    # Port ranges are left to the command line
+    if '-' in host_port or '-' in container_port or len(parts) > 2:
+        raise DockerApi.UnsupportedArgument('publish')
+    return container_port + '/' + protocol, dict(HostIp=host_ip, HostPort=host_port)
+
+
+# Run arguments whose order doesn't matter. The ones with 'key=value' items
+# are compared as dicts, because the last value for a key wins.
+UNORDERED_RUN_ARGS = frozenset(['add_host', 'cap_add', 'cap_drop', 'device', 'device_cgroup_rule', 'dns',
+                                'dns_option', 'dns_search', 'expose', 'group_add', 'link', 'link_local_ip',
+                                'network_alias', 'publish', 'security_opt', 'tmpfs', 'ulimit', 'volume',
+                                'volumes_from'])
+KEY_VALUE_RUN_ARGS = frozenset(['env', 'label', 'log_opt', 'storage_opt', 'sysctl'])
+
+# Run arguments that are sizes ('512m' is the same as '512M' or '536870912')
+SIZE_RUN_ARGS = frozenset(['kernel_memory', 'memory', 'memory_reservation', 'memory_swap', 'shm_size'])
+
+# Run arguments that are numbers or flags, even though they are passed as strings
+NUMBER_RUN_ARGS = frozenset(['cpus', 'memory_swappiness', 'oom_score_adj', 'pids_limit', 'stop_timeout'])
+FLAG_RUN_ARGS = frozenset(['oom_kill_disable', 'publish_all', 'read_only', 'privileged', 'rm', 'sig_proxy', 'tty'])
+
+
+def canonical_run_value(key, value):
+    """
+    Bring the value of a run argument into a canonical form, so that two
+    values that mean the same to docker compare equal.
+
+    :param key: The name of the argument.
+    :param value: The value of the argument.
+    :return: The canonical value.
+    """
+
+    try:
+        if key in KEY_VALUE_RUN_ARGS:
+            items = value if isinstance(value, list) else [value]
+            return sorted(dict((str(item).split('=', 1) + [''])[:2] for item in items).items())
+        if key in UNORDERED_RUN_ARGS:
+            items = [str(item) for item in value]
+            if key == 'publish':
+                # Docker binds to all addresses if none is given
+                items = ['%s:%s:%s' % (binding['HostIp'] if binding['HostIp'] != '0.0.0.0' else '',
+                                       binding['HostPort'], port) for port, binding in map(parse_port, items)]
+            elif key == 'expose':
+                items = [item if '/' in item else item + '/tcp' for item in items]
+            elif key == 'link':
+                items = [item if ':' in item else item + ':' + item for item in items]
+            return sorted(set(items))
+        if key in SIZE_RUN_ARGS:
+            return parse_bytes(value)
+        if key in NUMBER_RUN_ARGS:
+            return float(value)
+        if key in FLAG_RUN_ARGS:
+            return str(value).lower() in ('true', 'yes', 'on', '1')
+    except (ValueError, DockerApi.UnsupportedArgument):
+        # Whatever we can't parse is compared as it is
+        pass
+    return value
+
+
+def canonical_run_spec(spec):
+    """
+    Bring the arguments of 'docker run' (see Container.run_spec) into a
+    canonical form for comparing them.
+
+    :param spec: The arguments.
+    :return: The canonical arguments.
+    """
+
+    # Arguments that are not set are not passed to docker at all
+    args = dict((key, canonical_run_value(key, value)) for key, value in spec['args'].items() if value)
+    return dict(name=spec['name'],
+                image=normalize_image_ref(spec['image']) if spec['image'] else None,
+                command=spec['command'] or [],
+                foreground=bool(spec['foreground']),
+                args=args)
+
+
+def docker_backend(backend):
+    """
+    Choose how we talk to docker.
+
+    :param backend: 'cli', 'api' or 'auto' (use the API if the docker daemon
+                    is reachable over a unix socket, the command otherwise).
+    :return: A DockerCli or DockerApi object.
+    """
+
+    if backend == 'cli':
+        return DockerCli()
+
+    # We honor the same settings as the 'docker' command. If it's configured
+    # to talk to a remote daemon or to use a context, we leave it to it.
+    host = os.environ.get('DOCKER_HOST') or 'unix:///var/run/docker.sock'
+    if not host.startswith('unix://') or os.environ.get('DOCKER_CONTEXT'):
+        if backend == 'api':
+            raise Container.InvalidArgumentException("The API backend only supports unix sockets, DOCKER_HOST is " +
+                                                     host)
+        return DockerCli()
+
+    api = DockerApi(host[len('unix://'):])
+    if api.ping():
+        return api
+    if backend == 'api':
+        raise Container.InvalidArgumentException("Can't connect to the docker daemon at " + host)
+    return DockerCli()
+
+
+class RegistryDigests(object):
+    """
+    Looks up the digests of images in their registries, without downloading
+    anything but the headers of the manifests. The digests are cached on
+    disk for a while, so all containers on a host that use the same image
+    share one lookup.
+    """
+
+    # We ask for manifest lists first, because that's what 'docker pull'
+    # records in the 'RepoDigests' of multi platform images.
+    MANIFEST_TYPES = ', '.join(['application/vnd.docker.distribution.manifest.list.v2+json',
+                                'application/vnd.oci.image.index.v1+json',
+                                'application/vnd.docker.distribution.manifest.v2+json',
+                                'application/vnd.oci.image.manifest.v1+json'])
+
+    # Only one thread at a time should write the cache file
+    lock = threading.Lock()
+
+    def __init__(self, cache_path, ttl):
+        """
+        :param cache_path: The file to cache the digests in.
+        :param ttl: How many seconds a cached digest is used.
+        """
+
+        self.cache_path = cache_path
+        self.ttl = ttl
+
+    def digest(self, ref):
+        """
+        Get the digest the registry has for an image reference.
+
+        :param ref: The image reference.
+        :return: The digest or None if the registry couldn't tell us.
+        """
+
+        with RegistryDigests.lock:
+            cached = self._load().get(ref)
+        if cached and 0 <= time.time() - cached['checked'] < self.ttl:
+            return cached['digest']
+
+        import http.client as http_client
+
+        try:
+            digest = self._fetch(*self.split_ref(ref))
+        except (IOError, OSError, ValueError, http_client.HTTPException):
+            # If the registry can't be reached, we keep what we have
+            return None
+
+        with RegistryDigests.lock:
+            cache = self._load()
+            cache[ref] = dict(digest=digest, checked=time.time())
+            tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.rename(tmp_path, self.cache_path)
+        return digest
+
+    def _load(self):
+        """
+        Read the cached digests.
+
+        :return: A dict mapping image references to their cached digest.
+        """
+
+        try:
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    @staticmethod
+    def split_ref(ref):
+        """
+        Split an image reference into registry, repository and tag, the same
+        way docker does it.
+
+        :param ref: The image reference (e.g. 'debian:buster').
+        :return: A tuple with the registry, the repository and the tag.
+        """
+
+        name, tag = ref, 'latest'
+        if ':' in ref.rsplit('/', 1)[-1]:
+            name, tag = ref.rsplit(':', 1)
+
+        parts = name.split('/', 1)
+        if len(parts) == 2 and ('.' in parts[0] or ':' in parts[0] or parts[0] == 'localhost'):
+            registry, repository = parts
+        else:
+            registry, repository = 'docker.io', name
+        if registry == 'docker.io' and '/' not in repository:
+            repository = 'library/' + repository
+        return registry, repository, tag
+
+    @staticmethod
+    def _credentials(registry):
+        """
+        Get the credentials for a registry that 'docker login' stored in the
+        docker config. Credential helpers are not supported.
+
+        :param registry: The registry.
+        :return: The base64 encoded 'user:password' or None.
+        """
+
+        try:
+            config_dir = os.environ.get('DOCKER_CONFIG', os.path.expanduser('~/.docker'))
+            with open(os.path.join(config_dir, 'config.json')) as config_file:
+                auths = json.load(config_file).get('auths', dict())
+        except (IOError, OSError, ValueError):
+            return None
+
+        keys = [registry, 'https://' + registry, 'http://' + registry]
+        if registry == 'docker.io':
+            keys.append('https://index.docker.io/v1/')
+        for key in keys:
+            if auths.get(key, dict()).get('auth'):
+                return auths[key]['auth']
+        return None
+
+    def _fetch(self, registry, repository, tag):
+        """
+        Ask a registry for the digest of a manifest.
+
+        :param registry: The registry.
+        :param repository: The repository.
+        :param tag: The tag.
+        :return: The digest or None if the registry doesn't send one.
+        """
+
+        from urllib.request import Request as url_request, urlopen as url_open
+        from urllib.error import HTTPError as url_http_error
+
+        # Like docker, we talk plain HTTP to registries on the local host
+        host = 'registry-1.docker.io' if registry == 'docker.io' else registry
+        scheme = 'http' if host.split(':')[0] in ('localhost', '127.0.0.1', '::1') else 'https'
+        url = '%s://%s/v2/%s/manifests/%s' % (scheme, host, repository, tag)
+        credentials = self._credentials(registry)
+
+        headers = dict(Accept=self.MANIFEST_TYPES)
+        try:
+            response = url_open(url_request(url, headers=headers, method='HEAD'), timeout=10)
+        except url_http_error as e:
+            if e.code != 401:
+                raise
+            challenge = e.headers.get('WWW-Authenticate', '')
+            headers['Authorization'] = self._authorization(challenge, credentials)
+            response = url_open(url_request(url, headers=headers, method='HEAD'), timeout=10)
+        return response.headers.get('Docker-Content-Digest')
+
+    @staticmethod
+    def _authorization(challenge, credentials):
+        """
+        Answer the authentication challenge of a registry.
+
+        :param challenge: The 'WWW-Authenticate' header.
+        :param credentials: The base64 encoded credentials or None.
+        :return: The value for the 'Authorization' header.
+        """
+
+        from urllib.request import Request as url_request, urlopen as url_open
+
+        scheme, _, params = challenge.partition(' ')
+        if scheme.lower() == 'basic':
+            if not credentials:
+                raise ValueError('The registry needs credentials')
+            return 'Basic ' + credentials
+
+        # Get a token for the repository from the auth server
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        query = dict((key, params[key]) for key in ('service', 'scope') if key in params)
+        token_headers = dict()
+        if credentials:
+            token_headers['Authorization'] = 'Basic ' + credentials
+        response = url_open(url_request(params['realm'] + '?' + url_encode(query), headers=token_headers), timeout=10)
+        token = json.loads(response.read().decode('utf-8'))
+        return 'Bearer ' + (token.get('token') or token['access_token'])
+
+
+class DockerSnapshot(object):
+    """
+    The result of inspecting many containers and images at once. This way,
+    managing a list of containers costs two 'docker inspect' calls instead
+    of a couple of calls per container.
+    """
+
+    def __init__(self, docker, names, images):
+        """
+        Inspect all given containers and images.
+
+        :param docker: The DockerCli or DockerApi to use.
+        :param names: The names of the containers.
+        :param images: The references of the images.
+        """
+
+        # Only what was inspected is known not to exist
+        self.names = set(names)
+        self.refs = set(normalize_image_ref(ref) for ref in images if ref)
+        self.complete = False
+        self._index(docker.inspect('container', names), docker.inspect('image', images))
+
+    def _index(self, containers, images):
+        """
+        Remember the information about the containers and images.
+
+        :param containers: The inspect results of the containers.
+        :param images: The inspect results of the images.
+        """
+
+        self.containers = dict()
+        for info in containers:
+            self.containers[info['Name'].lstrip('/')] = info
+
+        # Images are looked up by all the references they are known by
+        self.images = dict()
+        for info in images:
+            for ref in [info['Id']] + (info.get('RepoTags') or []) + (info.get('RepoDigests') or []):
+                self.images[normalize_image_ref(ref)] = info
+
+        # What was changed since the snapshot was taken is not in it anymore
+        self.stale = set()
+
+    def lookup(self, object_type, ref):
+        """
+        Get the information about a container or an image.
+
+        :param object_type: 'container' or 'image'.
+        :param ref: The name/reference of the object.
+        :return: The inspect result of the object, None if it doesn't exist
+                 and False if the snapshot doesn't know anymore.
+        """
+
+        if (object_type, ref) in self.stale:
+            return False
+        if object_type == 'container':
+            return self.containers.get(ref) if self.complete or ref in self.names else False
+        ref = normalize_image_ref(ref)
+        if ref in self.images:
+            return self.images[ref]
+        return None if self.complete or ref in self.refs else False
+
+    def invalidate(self, object_type, ref):
+        """
+        Mark an object as changed, so its information won't be used anymore.
+
+        :param object_type: 'container' or 'image'.
+        :param ref: The name/reference of the object.
+        """
+
+        self.stale.add((object_type, ref))
+
+
+class FactCache(DockerSnapshot):
+    """
+    A snapshot of all containers and images on the host that is kept on disk
+    for a few seconds, so the tasks of a play that follow each other don't
+    have to inspect the same objects again. It is thrown away as soon as we
+    change something, and it isn't used if docker reports that a container
+    or image changed since it was taken (e.g. by someone else).
+    """
+
+    # Bump this if the format of the file changes
+    VERSION = 1
+
+    # Events that don't change what inspecting the objects tells us (the
+    # part before a ':', as in 'health_status: healthy')
+    READ_ONLY_EVENTS = frozenset(['attach', 'detach', 'resize', 'top', 'export', 'copy', 'archive-path',
+                                  'extract-to-dir', 'exec_create', 'exec_start', 'exec_die', 'exec_detach',
+                                  'health_status', 'save', 'push'])
+
+    def __init__(self, docker, path, ttl):
+        """
+        Load the cached snapshot, or inspect everything and cache it if it's
+        too old or outdated.
+
+        :param docker: The DockerCli or DockerApi to use.
+        :param path: The file to cache the snapshot in.
+        :param ttl: How many seconds the snapshot is used.
+        """
+
+        self.path = path
+        self.complete = True
+        self.from_cache = True
+
+        facts = self._load(docker, ttl)
+        if facts is None:
+            self.from_cache = False
+            taken = time.time()
+            containers, images = docker.inventory()
+            facts = dict(version=self.VERSION, taken=taken, containers=containers, images=images)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(facts, cache_file)
+            os.rename(tmp_path, path)
+
+        self.names = set(info['Name'].lstrip('/') for info in facts['containers'])
+        self.refs = set()
+        self._index(facts['containers'], facts['images'])
+
+    def _load(self, docker, ttl):
+        """
+        Read the cached snapshot if it can still be used.
+
+        :param docker: The DockerCli or DockerApi to use.
+        :param ttl: How many seconds the snapshot is used.
+        :return: The cached snapshot or None.
+        """
+
+        try:
+            with open(self.path) as cache_file:
+                facts = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        now = time.time()
+        if facts.get('version') != self.VERSION or not 0 <= now - facts.get('taken', 0) < ttl:
+            return None
+        for event in docker.events_between(facts['taken'], now):
+            action = event.get('Action') or event.get('status') or ''
+            if action.split(':', 1)[0] not in self.READ_ONLY_EVENTS:
+                return None
+        return facts
+
+    def invalidate(self, object_type, ref):
+        DockerSnapshot.invalidate(self, object_type, ref)
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class StateStore(object):
+    """
+    What we know about all containers managed by this module on the host
+    (the commands they were built and run with, the digest of the build
+    context, the image ID and some timestamps), kept in a single JSON file.
+    The file is always replaced atomically while holding an exclusive lock,
+    so neither parallel runs nor crashes can corrupt it and reading it never
+    needs a lock.
+    """
+
+    # Bump this if the format of the file changes
+    VERSION = 1
+
+    # flock() doesn't protect us from other threads of the same process
+    lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        :param path: The directory the state is stored in.
+        """
+
+        self.path = path
+        self.state_path = path + '/' + STATE_FILE
+        self.lock_path = path + '/' + STATE_LOCK_FILE
+
+    def read(self):
+        """
+        Read the state of all containers.
+
+        :return: A dict mapping container names to their state.
+        """
+
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file).get('containers', dict())
+        except (IOError, OSError, ValueError):
+            return dict()
+
+    def get(self, name):
+        """
+        Get the state of a container.
+
+        :param name: The name of the container.
+        :return: A dict with the state (empty if we don't know the container).
+        """
+
+        entry = self.read().get(name)
+        if entry is None:
+            entry = self._legacy_entry(name)
+        return entry or dict()
+
+    def update(self, name, fields):
+        """
+        Update the state of a container.
+
+        :param name: The name of the container.
+        :param fields: A dict with the values to update.
+        """
+
+        with StateStore.lock:
+            with open(self.lock_path, 'a') as lock_file:
+                # The lock is released when the file is closed
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                containers = self.read()
+                entry = containers.get(name) or self._legacy_entry(name) or dict()
+                entry.update(fields)
+                entry['updated'] = time.time()
+                containers[name] = entry
+                self._write(containers)
+
+                # The state of the container was migrated from a file written
+                # by an older version, which isn't needed anymore.
+                if os.path.isfile(self.path + '/' + name):
+                    os.remove(self.path + '/' + name)
+
+    def _write(self, containers):
+        """
+        Replace the state file.
+
+        :param containers: The state of all containers.
+        """
+
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(dict(version=self.VERSION, containers=containers), state_file, indent=1, sort_keys=True)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.rename(tmp_path, self.state_path)
+
+        # Make sure the rename itself is on disk as well
+        dir_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _legacy_entry(self, name):
+        """
+        Read the state of a container from the file older versions used
+        (the build command, the run command and the context digest, one per
+        line).
+
+        :param name: The name of the container.
+        :return: A dict with the state or None if there is no such file.
+        """
+
+        try:
+            with open(self.path + '/' + name) as commands_file:
+                lines = commands_file.read().split('\n')
+        except (IOError, OSError):
+            return None
+        lines += [''] * 3
+        return dict(build_command=lines[0], run_command=lines[1], context_digest=lines[2])
+
+
+class BackgroundJob(object):
+    """
+    A build or pull that runs detached from the module (see 'background'),
+    so it survives the end of the module execution. There is at most one job
+    per image. Its description is stored in a JSON file in JOBS_DIR, the
+    output of the command goes to a log file next to it and its exit code to
+    a status file once it's done. The description is only published once it
+    is complete, so a job file is either missing or readable.
+    """
+
+    # The job writes its exit code atomically, so we never read half of it
+    SCRIPT = 'log=$1; status=$2; shift 2; "$@" > "$log" 2>&1; echo $? > "$status.tmp"; mv "$status.tmp" "$status"'
+
+    # flock() doesn't protect us from other threads of the same process
+    lock = threading.Lock()
+
+    def __init__(self, jobs_path, image):
+        """
+        :param jobs_path: The directory with the jobs.
+        :param image: The image the job builds or pulls.
+        """
+
+        key = hashlib.sha256(image.encode('utf-8')).hexdigest()[:16]
+        self.path = jobs_path + '/' + key + '.json'
+        self.log_path = jobs_path + '/' + key + '.log'
+        self.status_path = jobs_path + '/' + key + '.status'
+        self.iid_path = jobs_path + '/' + key + '.iid'
+        self.lock_path = jobs_path + '/' + key + '.lock'
+        self.image = image
+        self.info = None
+
+    def load(self):
+        """
+        Load the description of the job.
+
+        :return: The description or None if there is no job for the image.
+        """
+
+        try:
+            with open(self.path) as job_file:
+                self.info = json.load(job_file)
+        except (IOError, OSError, ValueError):
+            self.info = None
+        return self.info
+
+    def start(self, kind, command, cwd=None, **fields):
+        """
+        Start the job, unless there already is one for the image.
+
+        :param kind: 'build' or 'pull'.
+        :param command: The docker command.
+        :param cwd: The directory to run the command in.
+        :param fields: What else to remember about the job.
+        :return: True if the job was started, False if there already is one
+                 (which is loaded then).
+        """
+
+        info = dict(fields, id='%s-%d' % (os.path.basename(self.path)[:-len('.json')], int(time.time() * 1000)),
+                    kind=kind, image=self.image, command=command, started=time.time(), log=self.log_path)
+
+        with BackgroundJob.lock:
+            with open(self.lock_path, 'a') as lock_file:
+                # The lock is released when the file is closed, even if we
+                # crash before the job is published
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                # A job file we can't read is as good as none
+                if self.load() is not None:
+                    return False
+                for path in (self.status_path, self.iid_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+                # The job gets a session of its own, so it isn't killed with us
+                with open(os.devnull, 'r+') as devnull:
+                    process = Popen(['sh', '-c', self.SCRIPT, 'sh', self.log_path, self.status_path] + command,
+                                    cwd=cwd, stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True)
+                info.update(pid=process.pid, boot_id=boot_id(), pid_started=process_start_time(process.pid))
+
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as job_file:
+                    json.dump(info, job_file)
+                os.rename(tmp_path, self.path)
+
+        self.info = info
+        return True
+
+    def status(self):
+        """
+        :return: 'running', 'succeeded' or 'failed'.
+        """
+
+        returncode = self.returncode()
+        if returncode is None:
+            if self._alive():
+                return 'running'
+            # The job may have finished since we looked. Otherwise it was
+            # killed (e.g. the host rebooted).
+            returncode = self.returncode()
+            if returncode is None:
+                return 'failed'
+        return 'succeeded' if returncode == 0 else 'failed'
+
+    def returncode(self):
+        """
+        :return: The exit code of the command or None if it's not done.
+        """
+
+        try:
+            with open(self.status_path) as status_file:
+                return int(status_file.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _alive(self):
+        # After a reboot or once the process is gone, its PID may be reused
+        if self.info.get('boot_id') and self.info['boot_id'] != boot_id():
+            return False
+        started = process_start_time(self.info['pid'])
+        if self.info.get('pid_started') and started != self.info['pid_started']:
+            return False
+        try:
+            os.kill(self.info['pid'], 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        # A job we started ourselves stays a zombie until it's reaped
+        try:
+            return os.waitpid(self.info['pid'], os.WNOHANG) == (0, 0)
+        except OSError:
+            return True
+
+    def wait(self, timeout):
+        """
+        Wait until the job is done.
+
+        :param timeout: How many seconds to wait at most.
+        :return: 'succeeded', 'failed' or 'running' if it timed out.
+        """
+
+        deadline = time.time() + timeout
+        delay = 0.05
+        while True:
+            status = self.status()
+            if status != 'running' or time.time() >= deadline:
+                return status
+            time.sleep(max(0, min(delay, deadline - time.time())))
+            delay = min(delay * 2, 1)
+
+    def image_id(self):
+        """
+        :return: The ID of the image the job built or None if it's unknown.
+        """
+
+        try:
+            with open(self.iid_path) as iid_file:
+                return iid_file.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def output(self, tail_lines):
+        """
+        Get the output of the job.
+
+        :param tail_lines: How many of the last lines to return.
+        :return: The last lines of the output.
+        """
+
+        output = CommandOutput(tail_lines)
+        try:
+            with open(self.log_path, errors='replace') as log_file:
+                for line in log_file:
+                    output.feed(line)
+        except (IOError, OSError):
+            pass
+        return output.text()
+
+    def remove(self):
+        """
+        Forget about the job, once its result is collected. The log is kept
+        until the next job for the image starts.
+        """
+
+        for path in (self.path, self.status_path, self.iid_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def result(self, status):
+        """
+        Get what we report back to ansible about the job.
+
+        :param status: The status of the job.
+        :return: A dict with the ID, the status and the log of the job.
+        """
+
+        return dict(id=self.info['id'], kind=self.info['kind'], status=status, log=self.log_path)
+
+
+def boot_id():
+    """
+    :return: The ID of the current boot of the host or None if it's unknown.
+    """
+
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as boot_id_file:
+            return boot_id_file.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def process_start_time(pid):
+    """
+    :param pid: The ID of a process.
+    :return: When the process started, in clock ticks since the boot, or None
+             if there is no such process or it's unknown.
+    """
+
+    try:
+        with open('/proc/%d/stat' % pid) as stat_file:
+            stat = stat_file.read()
+    except (IOError, OSError):
+        return None
+    # The name of the command in brackets may contain anything, the start
+    # time is the 20th field after it
+    try:
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+    except (ValueError, IndexError):
+        return None
+
+
+class DockerIgnore(object):
+    """
+    The patterns of a .dockerignore file, matched the same way docker matches
+    them when it sends the build context to the daemon.
+    """
+
+    def __init__(self, context_path, always_included=('Dockerfile', '.dockerignore')):
+        """
+        Read the .dockerignore file of a build context, if there is one.
+
+        :param context_path: The path to the build context.
+        :param always_included: Files that are part of the build no matter
+                                what the .dockerignore says (docker always
+                                sends the Dockerfile and the .dockerignore).
+        """
+
+        self.context_path = context_path
+        self.always_included = set(os.path.normpath(f) for f in always_included)
+
+        # A list of (exclusion, pattern string, compiled regex) tuples
+        self.patterns = []
+
+        try:
+            with open(os.path.join(context_path, '.dockerignore'), 'rb') as ignore_file:
+                lines = ignore_file.read().decode('utf-8', 'replace').splitlines()
+        except (IOError, OSError):
+            return
+
+        for line in lines:
+            # Like docker, we strip a BOM and ignore comment lines
+            line = line.lstrip(u'\ufeff')
+            if line.startswith('#'):
+                continue
+            pattern = line.strip()
+            if not pattern:
+                continue
 
-from __future__ import print_function
-import os
-import datetime
-import distutils.dir_util
-from distutils.errors import DistutilsFileError
-from subprocess import check_output as exec_command
-from subprocess import CalledProcessError
-from subprocess import STDOUT
-from six import iteritems
-from ansible.module_utils.basic import AnsibleModule
+            exclusion = pattern[0] == '!'
+            if exclusion:
+                pattern = pattern[1:].strip()
+            if pattern:
+                pattern = os.path.normpath(pattern)
+                if len(pattern) > 1 and pattern[0] == '/':
+                    pattern = pattern[1:]
 
-ANSIBLE_METADATA = {
-    'metadata_version': '1.1',
-    'status': ['preview'],
-    'supported_by': 'community'
-}
+            self.patterns.append((exclusion, pattern, re.compile(self._pattern_to_regex(pattern))))
 
-DOCKER_COMMANDS_PATH = '/var/local/ansible/docker_simple'
+    @staticmethod
+    def _pattern_to_regex(pattern):
+        """
+        Convert a .dockerignore pattern to a regular expression. This is a
+        port of what docker does, including its handling of '**'.
 
+        :param pattern: The cleaned pattern.
+        :return: The regular expression as a string.
+        """
 
-def fail(module, msg):
-    """
-    Notify ansible that the module execution failed.
+        regex = '^'
+        i = 0
+        while i < len(pattern):
+            char = pattern[i]
+            i += 1
+            if char == '*':
+                if i < len(pattern) and pattern[i] == '*':
+                    i += 1
+                    # '**/' is treated like '**'
+                    if i < len(pattern) and pattern[i] == '/':
+                        i += 1
+                    if i == len(pattern):
+                        regex += '.*'
+                    else:
+                        # This matches any number of directories, even none
+                        regex += '(.*/)?'
+                else:
+                    regex += '[^/]*'
+            elif char == '?':
+                regex += '[^/]'
+            elif char in '.+()|{}$':
+                regex += '\\' + char
+            elif char == '\\':
+                # Escape the next character
+                if i < len(pattern):
+                    regex += '\\' + pattern[i]
+                    i += 1
+                else:
+                    regex += '\\\\'
+            else:
+                regex += char
+        return regex + '$'
 
-    :param module: Interface to ansible.
-    :param msg: The error message to display.
-    :return: A dict indicating that something changed.
+    def ignored(self, relpath):
+        """
+        Check, whether a path in the build context is ignored. As in docker,
+        a pattern also matches everything below the directories it matches
+        and the last matching pattern wins.
+
+        :param relpath: The path relative to the build context.
+        :return: True if the path is not part of the build context.
+        """
+
+        if not self.patterns or relpath in self.always_included:
+            return False
+
+        parent_dirs = relpath.split('/')[:-1]
+        matched = False
+        for exclusion, _, regex in self.patterns:
+            # An inclusion can't change anything if the path is already
+            # ignored and the same goes for exclusions if it isn't.
+            if exclusion != matched:
+                continue
+
+            match = regex.match(relpath) is not None
+            if not match:
+                for i in range(len(parent_dirs)):
+                    if regex.match('/'.join(parent_dirs[:i + 1])):
+                        match = True
+                        break
+            if match:
+                matched = not exclusion
+        return matched
+
+    def _can_prune(self, reldir):
+        """
+        Check, whether an ignored directory can be skipped entirely. This is
+        only the case if no exclusion pattern could re-include something in
+        it, which is decided the same (conservative) way docker decides it.
+
+        :param reldir: The ignored directory relative to the build context.
+        :return: True if nothing below the directory is part of the context.
+        """
+
+        dir_slash = reldir + '/'
+        for exclusion, pattern, _ in self.patterns:
+            if exclusion and (pattern + '/').startswith(dir_slash):
+                return False
+        return True
+
+    def scan(self, visit, threads=CONTEXT_SCAN_THREADS):
+        """
+        Visit all files in the build context that are not ignored. The
+        directories are listed by a pool of threads, so the stat round trips
+        of a network file system overlap, and ignored directories are not
+        descended into if possible.
+
+        :param visit: Called with the os.DirEntry and the relative path of
+                      every file, from any of the threads. All threads stop
+                      as soon as it returns something other than None.
+        :param threads: How many directories are listed at the same time.
+        :return: A tuple with what visit returned (None if it never returned
+                 anything) and the number of files that were visited.
+        """
+
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+        from concurrent.futures import wait as wait_for_futures
+
+        stop = threading.Event()
+
+        def scan_directory(directory, prefix):
+            # Returns the subdirectories to scan next, the number of files
+            # visited and what visit returned, if anything.
+            try:
+                with os.scandir(directory) as iterator:
+                    entries = list(iterator)
+            except OSError:
+                # Like os.walk, we skip what vanished or can't be read
+                return [], 0, None
+
+            subdirs = []
+            files = 0
+            for entry in entries:
+                if stop.is_set():
+                    break
+                relpath = prefix + entry.name
+                # Like os.walk, we don't follow symlinks to directories
+                if entry.is_dir(follow_symlinks=False):
+                    if not (self.ignored(relpath) and self._can_prune(relpath)):
+                        subdirs.append((entry.path, relpath + '/'))
+                    continue
+                if self.ignored(relpath):
+                    continue
+                files += 1
+                result = visit(entry, relpath)
+                if result is not None:
+                    stop.set()
+                    return subdirs, files, result
+            return subdirs, files, None
+
+        result = None
+        files = 0
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = set([executor.submit(scan_directory, self.context_path, '')])
+            try:
+                while pending and result is None:
+                    done, pending = wait_for_futures(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        subdirs, visited, found = future.result()
+                        files += visited
+                        if result is None:
+                            result = found
+                        if result is None:
+                            pending.update(executor.submit(scan_directory, *subdir) for subdir in subdirs)
+            finally:
+                stop.set()
+                for future in pending:
+                    future.cancel()
+        # The directories that were being listed when we stopped
+        files += sum(future.result()[1] for future in pending if not future.cancelled())
+        return result, files
+
+    def newer_file(self, mtime_ns, threads=CONTEXT_SCAN_THREADS):
+        """
+        Look for a file in the build context that was modified after a point
+        in time, stopping as soon as one is found.
+
+        :param mtime_ns: The point in time in nanoseconds since the epoch.
+        :param threads: How many directories are listed at the same time.
+        :return: A tuple with the relative path of a newer file (None if
+                 there is none) and the number of files that were looked at.
+        """
+
+        def newer(entry, relpath):
+            # Docker copies symlinks as they are, so it's the mtime of the
+            # link that matters.
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime_ns > mtime_ns:
+                    return relpath
+            except OSError:
+                # The file vanished since the directory was listed
+                pass
+            return None
+
+        return self.scan(newer, threads)
+
+
+class ContextFingerprint(object):
+    """
+    Persistent index of the files in a build context. For every file it
+    records the size, mtime, inode, permissions and a hash of its content, so that only
+    files whose stat changed since the last run have to be hashed again. From
+    the index, a single digest of the whole build context is computed.
     """
 
-    module.fail_json(msg=msg, changed=True)
-    return dict(changed=True)
+    # Bump this if the format of the index changes, old indexes are discarded
+    VERSION = 2
+
+    def __init__(self, index_path, context_path, dockerignore):
+        """
+        Load the index of a build context from disk.
+
+        :param index_path: The file where the index is stored.
+        :param context_path: The path to the build context.
+        :param dockerignore: The DockerIgnore of the build context.
+        """
+
+        self.index_path = index_path
+        self.context_path = context_path
+        self.dockerignore = dockerignore
+        self.files = dict()
+        self.written = 0
+
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+        except (IOError, OSError, ValueError):
+            # A missing or broken index just means that we have to hash
+            # everything again.
+            return
+
+        # An index of a different context (or format) is of no use to us
+        if index.get('version') == self.VERSION and index.get('context') == context_path:
+            self.files = index.get('files', dict())
+            self.written = index.get('written', 0)
+
+    @staticmethod
+    def _stat_key(st):
+        """
+        Get the part of a stat result that tells us whether a file changed.
+
+        :param st: The stat result of a file.
+        :return: A list of the size, mtime (in nanoseconds), inode and
+                 permission bits.
+        """
+
+        mtime = getattr(st, 'st_mtime_ns', None)
+        if mtime is None:
+            mtime = int(st.st_mtime * 1000000000)
+        # A chmod only changes the ctime, but docker copies the permissions
+        return [st.st_size, mtime, st.st_ino, stat.S_IMODE(st.st_mode)]
+
+    @staticmethod
+    def _hash_file(path, st):
+        """
+        Hash the content of a file.
+
+        :param path: The path to the file.
+        :param st: The lstat result of the file.
+        :return: The hex digest of the content.
+        """
+
+        content_hash = hashlib.sha256()
+
+        # Docker copies symlinks as they are, so only the target matters
+        if stat.S_ISLNK(st.st_mode):
+            content_hash.update(b'link:' + os.readlink(path).encode('utf-8', 'surrogateescape'))
+            return content_hash.hexdigest()
+
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def digest(self):
+        """
+        Walk the build context, update the index and compute the digest of
+        the whole context.
+
+        :return: The hex digest of the build context.
+        """
+
+        files = dict()
+
+        # Files that are modified after this point might not be hashed with
+        # their final content, see below.
+        scan_start = int(time.time() * 1000000000)
+
+        def index(entry, relpath):
+            try:
+                # The stat result of the directory listing, so there is only
+                # one round trip per file (in one of the scan threads).
+                st = entry.stat(follow_symlinks=False)
+                key = self._stat_key(st)
+
+                # Only hash files whose stat changed. A file that was modified
+                # within the same timestamp tick as the index was written
+                # might have changed without its stat changing, so we don't
+                # trust the index for those (like git does).
+                indexed = self.files.get(relpath)
+                if indexed and indexed[:4] == key and key[1] < self.written:
+                    files[relpath] = indexed
+                else:
+                    files[relpath] = key + [self._hash_file(entry.path, st)]
+            except FileNotFoundError:
+                # The file vanished since the directory was listed
+                pass
+            except OSError:
+                # We can't tell what's in the file, so the digest is a new one
+                # every time and the key never matches the index.
+                files[relpath] = [-1, -1, -1, -1, 'unreadable:%d' % scan_start]
+
+        self.dockerignore.scan(index)
+
+        self.files = files
+        self.written = scan_start
+
+        context_hash = hashlib.sha256()
+        for relpath in sorted(files):
+            context_hash.update(relpath.encode('utf-8', 'surrogateescape') + b'\0' +
+                                ('%o' % files[relpath][3]).encode('ascii') + b'\0' +
+                                files[relpath][4].encode('ascii') + b'\n')
+        return context_hash.hexdigest()
+
+    def save(self):
+        """
+        Write the index back to disk.
+        """
+
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump(dict(version=self.VERSION,
+                           context=self.context_path,
+                           written=self.written,
+                           files=self.files), index_file)
+        os.rename(tmp_path, self.index_path)
 
 
 class Container:
@@ -115,11 +2425,71 @@ class Container:
         # Useful when running a container in the foreground
         self.run_stdout = ""
 
+        # Managing many containers at once shares the results of inspecting
+        # them (see DockerSnapshot).
+        self.snapshot = None
+
+        # How we talk to docker, see docker_backend()
+        self.docker = DockerCli()
+
+        # In check mode, nothing is changed. What would be done is planned
+        # instead, with the reasons for it (see _plan()).
+        self.check_mode = False
+        self.plan = []
+        self.planned_reasons = 0
+
+        # The results of inspecting the container and its image, see _inspect()
+        self.inspected = dict()
+
+        # How long everything takes, see Timings
+        self.timings = Timings(kwargs['name'])
+        self.trace = kwargs.pop('trace', False)
+
         # We need those values in a couple of places
         # 'name' is guaranteed to be present by ansible
         self.name = kwargs['name']
         self.image = kwargs.pop('image', None)
         self.path = kwargs.pop('path', None)
+        self.pull_check = kwargs.pop('pull_check', 'exists')
+        self.pull_check_ttl = kwargs.pop('pull_check_ttl', 600)
+        self.output_lines = kwargs.pop('output_lines', 100)
+        self.output_log = kwargs.pop('output_log', False)
+        self.background = kwargs.pop('background', False)
+        self.reload_on = kwargs.pop('reload_on', None) or []
+        self.reload_signal = kwargs.pop('reload_signal', None) or 'HUP'
+        self.reload_command = kwargs.pop('reload_command', None)
+        self.replace_strategy = kwargs.pop('replace_strategy', None) or 'stop_first'
+        self.keep_images = kwargs.pop('keep_images', None) or 0
+        self.build_cache = kwargs.pop('build_cache', None)
+        self.wait_for = kwargs.pop('wait_for', None)
+        self.wait_timeout = kwargs.pop('wait_timeout', 60)
+        self.job_timeout = kwargs.pop('job_timeout', 3600)
+        if self.wait_for and kwargs.get('foreground'):
+            raise Container.InvalidArgumentException("'wait_for' can't be used for containers in the foreground")
+
+        # When we last ran, started or restarted the container and how long it
+        # took until it was ready after that (see 'wait_for').
+        self.action_time = None
+        self.time_to_ready = None
+
+        # How many files of the build context were looked at and how long it
+        # took (None if it wasn't scanned)
+        self.context_scan = None
+
+        # The build or pull running in the background we started or waited
+        # for (see BackgroundJob) and whether it's still running.
+        self.job = None
+        self.job_pending = False
+
+        # Whether we built or pulled the image, and the container that brought
+        # the image up to date for all containers with the image (see
+        # run_batch(), None if we do it ourselves).
+        self.image_updated = False
+        self.image_source = None
+
+        # The containers that bring the local images this image is built on
+        # up to date before us, by reference (see run_batch()).
+        self.base_image_sources = dict()
 
         # Local and remote images are treated slightly differently
         if self.path:
@@ -128,8 +2498,12 @@ class Container:
                 raise Container.InvalidArgumentException("No tags are allowed when building a local image")
             self.image += ':local'
             self.is_local_image = True
+            # Every image has a cache directory of its own (see 'build_cache')
+            if self.build_cache:
+                self.build_cache = os.path.join(os.path.abspath(self.build_cache),
+                                                self.image[:-len(':local')].replace('/', '_'))
         else:
-            if self.image[:-6] == ':local':
+            if self.image and self.image[-6:] == ':local':
                 raise Container.InvalidArgumentException("The 'local' tag is reserved for locally built images")
             self.is_local_image = False
 
@@ -137,47 +2511,98 @@ class Container:
         # from one run to another, because that changes the behavior of e.g.
         # restart. We do that by saving the commands that were used for
         # starting the current sessions of the containers somewhere.
-        distutils.dir_util.mkpath(DOCKER_COMMANDS_PATH, mode=0o600)
+        os.makedirs(DOCKER_COMMANDS_PATH, mode=0o600, exist_ok=True)
+        self.state = StateStore(DOCKER_COMMANDS_PATH)
+        with self.timings.phase('state_read'):
+            self.prev_state = self.state.get(self.name)
+        self.prev_build_command = self.prev_state.get('build_command', '')
+        self.prev_run_command = self.prev_state.get('run_command', '')
+        self.prev_context_digest = self.prev_state.get('context_digest', '')
 
-        # With the mode 'r+', the file isn't created if it doesn't exist
-        try:
-            self.prev_commands_file = open(DOCKER_COMMANDS_PATH + '/' + self.name, 'r+')
-        except IOError:
-            self.prev_commands_file = open(DOCKER_COMMANDS_PATH + '/' + self.name, 'w+')
-        self.prev_build_command = self.prev_commands_file.readline()
-        self.prev_run_command = self.prev_commands_file.readline()
-
-        # Strip the newlines at the end
-        if self.prev_build_command and self.prev_build_command[-1] == '\n':
-            self.prev_build_command = self.prev_build_command[:-1]
-        if self.prev_run_command and self.prev_run_command[-1] == '\n':
-            self.prev_run_command = self.prev_run_command[:-1]
+        # What we know to be true after this run. The values are only
+        # updated once the image/container actually matches them, so a failed
+        # command is tried again the next time.
+        self.built_command = self.prev_build_command
+        self.ran_command = self.prev_run_command
+        self.ran_spec = self.prev_state.get('run_spec')
+        self.image_id = self.prev_state.get('image_id')
+        self.timestamps = dict()
+
+        # The IDs of the images built for the container, the newest first, and
+        # how much space removing the old ones freed (see 'keep_images').
+        self.image_history = self.prev_state.get('image_history') or ([self.image_id] if self.image_id else [])
+        self.reclaimed_bytes = 0
+
+        # The IDs of the local images the image was built on, see
+        # local_base_images(). They are only updated when it's built.
+        self.base_image_ids = self.prev_state.get('base_image_ids')
+        self.build_base_image_ids = None
+
+        # The digest of the files in 'reload_on' the container was started or
+        # last reloaded with.
+        self.reload_digest = self.prev_state.get('reload_digest')
+        self.current_reload_digest = None
+
+        # The digest of the build context the current image was built from.
+        # It's only updated once we know that the image matches the context.
+        self.context_digest = self.prev_context_digest
+        self.build_context_digest = None
+
+        # The Dockerfile is part of the build, even if it's in .dockerignore
+        self.dockerfile = (kwargs.get('build_args') or dict()).get('file') or 'Dockerfile'
+
+        # Without an image (only allowed for stopping a container), there
+        # are no commands we could construct.
+        if not self.image:
+            self.build_command = self.run_command = None
+            self.build_command_str = self.run_command_str = None
+            return
 
         # Construct the docker commands that we might have to execute
         self.build_command = self._construct_docker_build_command(self.image, **kwargs)
+
+        # The build args must not end up in the run command
+        kwargs.pop('build_args', None)
         self.run_command = self._construct_docker_run_command(self.image, **kwargs)
 
+        # The same as the run command, but in a structured form
+        self.run_spec = dict(name=self.name, image=self.image,
+                             command=kwargs.pop('command'), foreground=kwargs.pop('foreground'),
+                             args=kwargs)
+
         # We also need the string version in some places
         self.build_command_str = ' '.join(self.build_command)
         self.run_command_str = ' '.join(self.run_command)
 
-    def __del__(self):
+    def save_state(self):
         """
-        Save the current build and run commands to a file if the container is
-        running now.
+        Save what we know about the container and its image now, so the next
+        run can tell what changed.
         """
 
-        # If the state is 'stopped', the 'image' argument doesn't have to be
-        # passed, thus the commands will be None. We don't want to save that,
-        # because if the container is started again with the same arguments
-        # as before it was stopped, we don't have to recreate the container.
-        if self.run_command and self.build_command:
-            # In case we opened the file in 'r+' mode and read it first
-            self.prev_commands_file.seek(0)
-            self.prev_commands_file.write(self.build_command_str + '\n' +
-                                          self.run_command_str)
-            self.prev_commands_file.truncate()
-        self.prev_commands_file.close()
+        fields = dict(build_command=self.built_command,
+                      run_command=self.ran_command,
+                      context_digest=self.context_digest,
+                      image_id=self.image_id,
+                      run_spec=self.ran_spec,
+                      base_image_ids=self.base_image_ids,
+                      reload_digest=self.reload_digest,
+                      image_history=self.image_history,
+                      **self.timestamps)
+        if self.check_mode:
+            return
+        if any(self.prev_state.get(key) != value for key, value in fields.items()):
+            with self.timings.phase('state_write'):
+                self.state.update(self.name, fields)
+            self.prev_state.update(fields)
+
+    def save_trace(self):
+        """
+        Append the timings to the trace file, if we are asked to.
+        """
+
+        if self.trace:
+            self.timings.write_trace(DOCKER_COMMANDS_PATH + '/' + TRACE_FILE)
 
     def ensure_running(self):
         """
@@ -187,26 +2612,175 @@ class Container:
 
         self.ensure_image_is_updated()
 
-        if self.run_command_str != self.prev_run_command:
+        # The container can't be created before its image is ready
+        if self.job_pending:
+            return
+
+        arguments_changed = self._run_arguments_changed()
+        if arguments_changed:
             self.change_reason.append("Arguments changed for run command")
             self.change_reason.append(self.run_command_str)
             self.change_reason.append(self.prev_run_command)
+        else:
+            # Nothing changed that matters to docker, so we remember the
+            # arguments the way they are written now.
+            self.ran_command = self.run_command_str
+            self.ran_spec = self.run_spec
 
         runs = self.running()
+        recreate = self.changed or arguments_changed
+
+        # If only resource limits or the restart policy changed, we don't
+        # have to recreate the container.
+        if recreate and not self.changed and runs is not None and self._update_in_place():
+            recreate = False
+
         if runs:
-            if self.changed or self.run_command_str != self.prev_run_command:
-                self.stop()
-                self.remove()
-                self.run()
+            if recreate:
+                self.replace()
+            elif self._reload_files_changed():
+                self.reload()
         elif runs is None:
             self.run()
         else:
-            if self.changed or self.run_command_str != self.prev_run_command:
+            if recreate:
                 self.remove()
                 self.run()
             else:
                 self.start()
 
+        # Either way, the container now runs with the current files
+        self._record_reload_digest()
+
+    def _reload_files_changed(self):
+        """
+        Check, whether one of the files in 'reload_on' changed since the
+        container was started or reloaded.
+
+        :return: True if the container needs to be reloaded, False otherwise.
+        """
+
+        # If we don't know the files the container was started with, we
+        # assume it's the current ones.
+        if not self.reload_on or self.reload_digest is None:
+            return False
+        if self._reload_files_digest() == self.reload_digest:
+            return False
+        self.change_reason.append("Files changed: " + ', '.join(self.reload_on))
+        return True
+
+    def _record_reload_digest(self):
+        """
+        Remember that the container runs with the current files in 'reload_on'.
+        """
+
+        self.reload_digest = self._reload_files_digest() if self.reload_on else None
+
+    def _reload_files_digest(self):
+        """
+        Compute a digest of the content of the files in 'reload_on'.
+        Directories are included with all files in them.
+
+        :return: The hex digest.
+        """
+
+        if self.current_reload_digest is not None:
+            return self.current_reload_digest
+
+        with self.timings.phase('reload_scan'):
+            digest = hashlib.sha256()
+            for reload_path in self.reload_on:
+                paths = [reload_path]
+                if os.path.isdir(reload_path):
+                    paths = sorted(os.path.join(directory, name)
+                                   for directory, _, names in os.walk(reload_path) for name in names)
+                for path in paths:
+                    try:
+                        content_hash = ContextFingerprint._hash_file(path, os.lstat(path))
+                    except (IOError, OSError):
+                        content_hash = 'missing'
+                    digest.update(path.encode('utf-8', 'surrogateescape') + b'\0' +
+                                  content_hash.encode('ascii') + b'\n')
+        self.current_reload_digest = digest.hexdigest()
+        return self.current_reload_digest
+
+    def wait_until_ready(self):
+        """
+        Wait until the container is running or healthy, if we are asked to.
+        """
+
+        if not self.wait_for or self.job_pending or self.check_mode:
+            return
+        started = self.action_time or time.time()
+        with self.timings.phase('wait'):
+            self.docker.wait(self.name, self.wait_for, self.wait_timeout)
+        self.time_to_ready = round(time.time() - started, 3)
+
+    def _run_arguments_changed(self):
+        """
+        Check, whether the run arguments differ from the ones the container
+        was run with. Differences that don't matter to docker (the order of
+        e.g. 'env' or 'volume', '512m' vs '512M', ...) are ignored.
+
+        :return: True if the container has to be changed, False otherwise.
+        """
+
+        # Older versions only stored the command
+        if not self.ran_spec:
+            return self.run_command_str != self.prev_run_command
+        return canonical_run_spec(self.ran_spec) != canonical_run_spec(self.run_spec)
+
+    def _update_in_place(self):
+        """
+        Apply changed run arguments to the existing container with 'docker
+        update', if that's possible for all arguments that changed.
+
+        :return: True if the container was updated, False if it has to be
+                 recreated.
+        """
+
+        updates = self._updatable_changes()
+        if not updates:
+            return False
+        try:
+            self.update(updates)
+        except CalledProcessError as e:
+            self.change_reason.append("'docker update' failed, recreating the container instead: " + e.output)
+            return False
+        return True
+
+    def _updatable_changes(self):
+        """
+        Compare the run arguments to the ones the container was run with.
+
+        :return: A dict with the changed arguments if all of them can be
+                 changed with 'docker update', None otherwise.
+        """
+
+        if not self.ran_spec:
+            return None
+        prev_spec, spec = canonical_run_spec(self.ran_spec), canonical_run_spec(self.run_spec)
+        if any(prev_spec[key] != spec[key] for key in ('name', 'image', 'command', 'foreground')):
+            return None
+
+        prev_args, args = prev_spec['args'], self.run_spec['args']
+        changed = set(key for key in set(prev_args) | set(spec['args'])
+                      if prev_args.get(key) != spec['args'].get(key))
+        if not changed or not changed.issubset(UPDATABLE_ARGS):
+            return None
+
+        # 'docker update' can't reset a limit to the default, only the
+        # restart policy has an explicit default.
+        updates = dict()
+        for key in changed:
+            if args.get(key):
+                updates[key] = args[key]
+            elif key == 'restart':
+                updates[key] = 'no'
+            else:
+                return None
+        return updates
+
     def ensure_stopped(self):
         """
         Make sure that the container is stopped.
@@ -232,6 +2806,7 @@ class Container:
                 self.run()
             else:
                 self.start()
+        self._record_reload_digest()
 
     def ensure_image_is_updated(self):
         """
@@ -239,6 +2814,17 @@ class Container:
         necessary.
         """
 
+        # With a list of containers, the image was already brought up to date
+        if self.image_source is not None:
+            if self.image_source is not self:
+                self._adopt_image(self.image_source)
+            return
+
+        # A build or pull in the background has to be done first
+        self._attach_job()
+        if self.job_pending:
+            return
+
         if self.is_local_image:
             if self.needs_rebuild():
                 self.build()
@@ -246,91 +2832,434 @@ class Container:
             if self.needs_pull():
                 self.pull()
 
-    def needs_rebuild(self):
+    def _adopt_image(self, source):
+        """
+        Take over the image another container with the same image brought up
+        to date.
+
+        :param source: The other Container.
+        """
+
+        self.image_id = source.image_id
+        self.job, self.job_pending = source.job, source.job_pending
+        if self.is_local_image and source.built_command == self.build_command_str:
+            self.built_command = source.built_command
+            self.context_digest = source.context_digest
+            self.base_image_ids = source.base_image_ids
+        if source.image_updated:
+            self.change_reason.append("Image updated for container " + source.name)
+            self.changed = True
+
+    def _job(self):
+        """
+        Get the background job for the image of the container.
+
+        :return: A BackgroundJob.
+        """
+
+        jobs_path = DOCKER_COMMANDS_PATH + '/' + JOBS_DIR
+        os.makedirs(jobs_path, mode=0o700, exist_ok=True)
+        return BackgroundJob(jobs_path, self.image)
+
+    def _start_job(self, job, kind, command, cwd=None, **fields):
+        """
+        Start a build or pull in the background.
+
+        :param job: The BackgroundJob.
+        :param kind: 'build' or 'pull'.
+        :param command: The docker command.
+        :param cwd: The directory to run the command in.
+        :param fields: What else to remember about the job.
+        """
+
+        self._invalidate('image', self.image)
+        if job.start(kind, command, cwd, **fields):
+            self.change_reason.append("Started 'docker %s' in the background (job %s)" % (kind, job.info['id']))
+            self.changed = True
+        else:
+            # Someone else was faster
+            self.change_reason.append("'docker %s' is already running in the background (job %s)" %
+                                      (job.info['kind'], job.info['id']))
+        self.job = job.result('running')
+        self.job_pending = True
+
+    def _attach_job(self):
+        """
+        Collect the result of a build or pull of the image that runs in the
+        background. If it's still running, we wait for it, unless we are
+        running in the background ourselves.
+
+        :raises CalledProcessError: If the job failed.
+        """
+
+        job = self._job()
+        if job.load() is None:
+            return
+        info = job.info
+
+        status = job.status()
+        if self.check_mode:
+            # What comes after the job depends on its outcome
+            self.change_reason.append("'docker %s' in the background (job %s) is %s" %
+                                      (info['kind'], info['id'], status))
+            self.job = job.result(status)
+            self.job_pending = True
+            return self._plan('collect_job')
+        if status == 'running':
+            if self.background:
+                self.change_reason.append("'docker %s' is still running in the background (job %s)" %
+                                          (info['kind'], info['id']))
+                self.job = job.result(status)
+                self.job_pending = True
+                return
+            with self.timings.phase('wait_job'):
+                status = job.wait(self.job_timeout)
+            if status == 'running':
+                raise CalledProcessError(-1, info['command'], "'docker %s' in the background (job %s) is still running "
+                                         "after %s seconds" % (info['kind'], info['id'], self.job_timeout))
+
+        self.job = job.result(status)
+        self._invalidate('image', self.image)
+        if status == 'failed':
+            returncode, output = job.returncode(), job.output(self.output_lines)
+            job.remove()
+            raise CalledProcessError(-1 if returncode is None else returncode, info['command'], output)
+
+        if info['kind'] == 'build':
+            self.image_id = job.image_id()
+            self.timestamps['built'] = time.time()
+            self.image_updated = True
+            # The image is only what we would build now, if it was built
+            # with the same command. Otherwise needs_rebuild() sorts it out.
+            if info.get('build_command') == self.build_command_str:
+                self.built_command = self.prev_build_command = info['build_command']
+                self.context_digest = self.prev_context_digest = info['context_digest']
+                self.base_image_ids = info.get('base_image_ids')
+            self._swap_build_cache(info.get('build_cache'))
+        else:
+            self.image_id = (self._image_info() or dict()).get('Id')
+            self.timestamps['pulled'] = time.time()
+            self.image_updated = True
+        job.remove()
+        self.change_reason.append("Finished 'docker %s' in the background (job %s)" % (info['kind'], info['id']))
+        self.changed = True
+        if info['kind'] == 'build':
+            self._remove_old_images()
+
+    def needs_rebuild(self):
+        """
+        Check, whether the image needs to be rebuilt. This function computes
+        a digest of the content of the build context and compares it to the
+        digest of the context the current image was built from.
+
+        :return: True if the image needs to be rebuilt, False otherwise.
+        """
+
+        # We need the digest in any case, because it's stored after the build
+        self.build_context_digest = self._fingerprint_context()
+
+        # If the build command changed, we definitely have to rebuild it
+        if self.build_command_str != self.prev_build_command:
+            self.change_reason.append("Arguments changed for build command")
+            self.change_reason.append(self.build_command_str)
+            self.change_reason.append(self.prev_build_command)
+            return True
+
+        # If a local image it is built on was rebuilt, it has to be rebuilt too
+        if self._base_images_changed():
+            return True
+
+        if self.prev_context_digest:
+            if self.build_context_digest == self.prev_context_digest:
+                return self._image_missing()
+            self.change_reason.append("Build context changed")
+            return True
+
+        # We don't know the digest of the context the image was built from
+        # yet (e.g. the image was built by an older version of this module),
+        # so we have to ask the image itself.
+        if self._image_outdated():
+            return True
+        self.context_digest = self.build_context_digest
+        return False
+
+    def _image_missing(self):
+        """
+        Check, whether the image that was built from the current build
+        context is gone (e.g. because the images were pruned).
+
+        :return: True if the image needs to be rebuilt, False otherwise.
+        """
+
+        # Docker doesn't remove an image that a container uses, and we
+        # inspect the container anyway.
+        container_info = self._container_info() if self.image_id else None
+        if container_info and container_info.get('Image') == self.image_id:
+            return False
+
+        image_info = self._image_info()
+        if image_info is None:
+            self.change_reason.append("Image not found, needs rebuild")
+            return True
+        self.image_id = image_info['Id']
+        return False
+
+    def local_base_images(self):
+        """
+        Get the locally built images (':local') the image is built on,
+        according to its Dockerfile.
+
+        :return: A list with the references of the images.
+        """
+
+        if not self.is_local_image:
+            return []
+        dockerfile = os.path.join(self.path, self.dockerfile)
+        return [ref for ref in dockerfile_base_images(dockerfile) if ref.endswith(':local')]
+
+    def _base_image_ids(self):
+        """
+        Get the current IDs of the local images the image is built on.
+
+        :return: A dict mapping the references of the images to their IDs
+                 (None if an image doesn't exist).
+        """
+
+        return dict((ref, (self._inspect('image', ref) or dict()).get('Id')) for ref in self.local_base_images())
+
+    def _base_images_changed(self):
+        """
+        Check, whether one of the local images the image is built on changed
+        since it was built.
+
+        :return: True if the image needs to be rebuilt, False otherwise.
+        """
+
+        self.build_base_image_ids = self._base_image_ids()
+
+        # In check mode, the base images we would build are not built yet
+        if self.check_mode:
+            for ref, source in sorted(self.base_image_sources.items()):
+                if source.image_updated:
+                    self.change_reason.append("Base image changed: " + ref)
+                    return True
+
+        # Images built by older versions of the module are assumed to be
+        # built on the current base images.
+        if self.base_image_ids is None:
+            self.base_image_ids = self.build_base_image_ids
+            return False
+
+        for ref, image_id in sorted(self.build_base_image_ids.items()):
+            if self.base_image_ids.get(ref) != image_id:
+                self.change_reason.append("Base image changed: " + ref)
+                return True
+        return False
+
+    def _fingerprint_context(self):
+        """
+        Compute the digest of the build context, using and updating the
+        fingerprint index of this container.
+
+        :return: The hex digest of the build context.
+        """
+
+        fingerprints_path = DOCKER_COMMANDS_PATH + '/' + FINGERPRINTS_DIR
+        os.makedirs(fingerprints_path, mode=0o700, exist_ok=True)
+        start = time.time()
+        with self.timings.phase('context_scan'):
+            fingerprint = ContextFingerprint(fingerprints_path + '/' + self.name, os.path.abspath(self.path),
+                                             self._dockerignore())
+            digest = fingerprint.digest()
+            fingerprint.save()
+        self._count_scan(len(fingerprint.files), start)
+        return digest
+
+    def _count_scan(self, files, start):
+        """
+        Add a scan of the build context to what we report about the scans.
+
+        :param files: How many files were looked at.
+        :param start: When the scan started.
+        """
+
+        scan = self.context_scan or dict(files=0, seconds=0)
+        self.context_scan = dict(files=scan['files'] + files,
+                                 seconds=round(scan['seconds'] + time.time() - start, 3))
+
+    def _image_outdated(self):
         """
-        Check, whether the image needs to be rebuilt. This function looks at
-        the path to the Dockerfile and checks, whether any files there are
-        newer than the docker image.
+        Check, whether the docker image was built from the current build
+        context and build command, according to its labels. Images without
+        those labels are compared to the modification times of the files in
+        the build context instead.
 
         :return: True if the image needs to be rebuilt, False otherwise.
         """
 
-        # If the build command changed, we definitely have to rebuild it
-        if self.build_command_str != self.prev_build_command:
-            self.change_reason.append("Arguments changed for build command")
-            self.change_reason.append(self.build_command_str)
-            self.change_reason.append(self.prev_build_command)
-            return True
-
-        # Get the creation time of the docker image
-        try:
-            time_str = exec_command(['docker', 'inspect', '--format', '{{.Created}}', self.image], stderr=STDOUT, universal_newlines=True)
-        except CalledProcessError:
+        # Get the creation time and the labels of the docker image
+        image_info = self._image_info()
+        if image_info is None:
             # If that command fails, we assume that the image was not found
             self.change_reason.append("Image not found, needs rebuild")
             return True
 
-        # Convert the time to a format we can use for comparisons
-        image_creation_time = datetime.datetime.strptime(time_str[:26], "%Y-%m-%dT%H:%M:%S.%f")
+        self.image_id = image_info['Id']
+        labels = image_info['Config'].get('Labels') or dict()
+        if CONTEXT_DIGEST_LABEL in labels:
+            if labels[CONTEXT_DIGEST_LABEL] == self.build_context_digest and \
+                    labels.get(BUILD_COMMAND_LABEL) == self._build_command_hash():
+                return False
+            self.change_reason.append("Build context changed")
+            return True
 
-        # Iterate over all files in the image path to see if any of those files
-        # were more recently modified than the image creation time.
-        for root, subdirs, files in os.walk(self.path):
-            for filename in files:
-                file_mtime = datetime.datetime.utcfromtimestamp(os.path.getmtime(os.path.join(root, filename)))
-                if image_creation_time < file_mtime:
-                    self.change_reason.append("File changed: " + filename)
-                    return True
+        # Look for a file in the build context that was modified after the
+        # image was created.
+        start = time.time()
+        with self.timings.phase('context_scan'):
+            newer, files = self._dockerignore().newer_file(parse_docker_time(image_info['Created']))
+        self._count_scan(files, start)
+        if newer is not None:
+            self.change_reason.append("File changed: " + newer)
+            return True
         return False
 
+    def _dockerignore(self):
+        """
+        Get the patterns of the .dockerignore file in the build context.
+
+        :return: A DockerIgnore object.
+        """
+
+        return DockerIgnore(os.path.abspath(self.path), always_included=('.dockerignore', self.dockerfile))
+
     def needs_pull(self):
         """
         Check, whether the image for the container already exists locally or
-        if it has to be pulled first. This function can currently not check,
-        if the local version is also the newest one, it only checks whether
-        it exists locally or not.
+        if it has to be pulled first. With 'pull_check: digest', the image is
+        also pulled if the registry has a different version of it.
 
-        :return: True if it needs to be pulled and doesn't exist locally, False otherwise.
+        :return: True if it needs to be pulled, False otherwise.
         """
 
-        try:
-            return not exec_command(['docker', 'inspect', '--format', '{{.ID}}', self.image], stderr=STDOUT, universal_newlines=True)
-        except CalledProcessError:
-            # If that command fails, we assume that the image was not found locally
+        image_info = self._image_info()
+        if not image_info:
             self.change_reason.append("Image not found, needs pull")
             return True
+        self.image_id = image_info['Id']
+
+        # Images referenced by their digest can't change
+        if self.pull_check != 'digest' or '@' in self.image:
+            return False
+
+        registry_digests = RegistryDigests(DOCKER_COMMANDS_PATH + '/' + REGISTRY_DIGESTS_FILE, self.pull_check_ttl)
+        with self.timings.phase('registry_check'):
+            remote_digest = registry_digests.digest(self.image)
+        local_digests = [repo_digest.split('@', 1)[1] for repo_digest in image_info.get('RepoDigests') or []]
+        if remote_digest is None or remote_digest in local_digests:
+            return False
+        self.change_reason.append("Newer image available in the registry: " + remote_digest)
+        return True
 
     def running(self):
         """
         Check, whether the container is running or not.
 
-        :return: True if it is running, False otherwise.
+        :return: True if it is running, False if it is stopped and None if it
+                 doesn't exist.
         """
 
-        try:
-            # This will either be 'true' (container runs), 'false' (container
-            # is stopped) or throw an exception (container doesn't exist).
-            return 'true' in exec_command(['docker', 'inspect', '--format', '"{{.State.Running}}"', self.name], stderr=STDOUT, universal_newlines=True)
-        except CalledProcessError as e:
-            # If that command fails, the container is not just not running, but it also doesn't exist
-            return None
+        container_info = self._container_info()
+        return container_info['State']['Running'] if container_info else None
+
+    def _container_info(self):
+        """
+        Inspect the container.
+
+        :return: The inspect result or None if the container doesn't exist.
+        """
+
+        return self._inspect('container', self.name)
+
+    def _image_info(self):
+        """
+        Inspect the image of the container.
+
+        :return: The inspect result or None if the image doesn't exist.
+        """
+
+        return self._inspect('image', self.image)
+
+    def _inspect(self, object_type, ref):
+        """
+        Inspect a docker object. The result is kept until the object is
+        changed by us, so every object is inspected at most once between two
+        changes, no matter how many questions we have about it.
+
+        :param object_type: 'container' or 'image'.
+        :param ref: The name/reference of the object.
+        :return: The inspect result or None if the object doesn't exist.
+        """
+
+        key = (object_type, ref)
+        if key not in self.inspected:
+            info = self.snapshot.lookup(object_type, ref) if self.snapshot else False
+            if info is False:
+                with self.timings.phase('inspect'):
+                    found = self.docker.inspect(object_type, [ref])
+                info = found[0] if found else None
+            self.inspected[key] = info
+        return self.inspected[key]
 
     def run(self):
         """
         Run the container.
         """
 
-        self.run_stdout = exec_command(self.run_command, stderr=STDOUT, universal_newlines=True)
+        if self.check_mode:
+            return self._plan('run')
+
+        self._invalidate('container', self.name)
+        self.action_time = time.time()
+        with self.timings.phase('run'):
+            self.run_stdout = self.docker.run(self.run_command, self.run_spec, self._output())
+        self.ran_command = self.run_command_str
+        self.ran_spec = self.run_spec
+        self.timestamps['ran'] = time.time()
         self.change_reason.append("Executed 'docker run'")
         self.changed = True
 
+    def update(self, updates):
+        """
+        Change resource limits or the restart policy of the existing container.
+
+        :param updates: A dict with the changed run arguments.
+        """
+
+        if self.check_mode:
+            return self._plan('update')
+
+        self._invalidate('container', self.name)
+        with self.timings.phase('update'):
+            self.docker.update(self.name, updates)
+        self.ran_command = self.run_command_str
+        self.ran_spec = self.run_spec
+        self.change_reason.append("Executed 'docker update' (in place: " + ', '.join(sorted(updates)) + ")")
+        self.changed = True
+
     def start(self):
         """
         Starts an existing container.
         """
 
+        if self.check_mode:
+            return self._plan('start')
+
         self.change_reason.append("Executed 'docker start'")
-        exec_command(['docker', 'start', self.name], stderr=STDOUT, universal_newlines=True)
+        self._invalidate('container', self.name)
+        self.action_time = time.time()
+        with self.timings.phase('start'):
+            self.docker.start(self.name)
         self.changed = True
 
     def restart(self):
@@ -339,21 +3268,184 @@ class Container:
         """
 
         if self.changed:
-            self.stop()
-            self.remove()
-            self.run()
+            self.replace()
+        elif self.check_mode:
+            self._plan('restart')
         else:
             self.change_reason.append("Executed 'docker restart'")
-            exec_command(['docker', 'restart', self.name], stderr=STDOUT, universal_newlines=True)
+            self._invalidate('container', self.name)
+            self.action_time = time.time()
+            with self.timings.phase('restart'):
+                self.docker.restart(self.name)
             self.changed = True
 
+    def replace(self):
+        """
+        Replace the running container with a new one. With 'replace_strategy:
+        start_first', the new container is started before the old one is
+        stopped, if that's possible.
+        """
+
+        if self.check_mode:
+            return self._plan('recreate')
+
+        if self.replace_strategy == 'start_first':
+            blocker = self._start_first_blocker()
+            if blocker is None and self._replace_start_first():
+                return
+            if blocker is not None:
+                self.change_reason.append("Can't start the new container first (%s), stopping the old one first" %
+                                          blocker)
+
+        self.stop()
+        self.remove()
+        self.run()
+
+    def _start_first_blocker(self):
+        """
+        Check, whether the new container can run next to the old one.
+
+        :return: Why it can't or None if it can.
+        """
+
+        args = self.run_spec['args']
+        if self.run_spec['foreground']:
+            return 'it runs in the foreground'
+        if args.get('network') == 'host':
+            return 'it uses the host network'
+        for port in args.get('publish') or []:
+            try:
+                if parse_port(port)[1]['HostPort']:
+                    return 'it publishes fixed host ports'
+            except (ValueError, DockerApi.UnsupportedArgument):
+                return 'it publishes fixed host ports'
+        for key in ('ip', 'ip6', 'mac_address', 'cidfile'):
+            if args.get(key):
+                return "it has a fixed '%s'" % key
+        return None
+
+    def _plan(self, action):
+        """
+        Record an action we would take if we weren't in check mode, together
+        with the reasons that were found for it since the last action.
+
+        :param action: The action, e.g. 'build' or 'recreate'.
+        """
+
+        self.plan.append(dict(action=action, reason=self.change_reason[self.planned_reasons:]))
+        self.change_reason.append("Would " + action.replace('_', ' '))
+        self.planned_reasons = len(self.change_reason)
+        self.changed = True
+
+    def _replace_start_first(self):
+        """
+        Start the new container under a temporary name, wait until it's
+        running (or healthy, if it has a health check), then stop and remove
+        the old one and give the new one its name.
+
+        :return: True if the container was replaced, False if the new
+                 container couldn't be started next to the old one.
+        :raises CalledProcessError: If the new container doesn't get ready.
+        """
+
+        temp_name = self.name + '-replacement'
+
+        # Left over from an attempt that failed
+        if self._inspect('container', temp_name):
+            self._remove_replacement(temp_name)
+
+        # On user defined networks, the new container is reachable under the
+        # name of the old one from the start.
+        args = dict(self.run_spec['args'], name=temp_name)
+        network = args.get('network')
+        if network and network not in ('bridge', 'default', 'none') and not network.startswith('container:'):
+            args['network_alias'] = (args.get('network_alias') or []) + [self.name]
+        spec = dict(self.run_spec, name=temp_name, args=args)
+        command = self._construct_docker_run_command(self.image, command=spec['command'], foreground=False, **args)
+
+        self._invalidate('container', temp_name)
+        self.action_time = time.time()
+        try:
+            with self.timings.phase('run'):
+                self.run_stdout = self.docker.run(command, spec, self._output())
+        except CalledProcessError as e:
+            # E.g. a port that is already in use
+            self.change_reason.append("Can't start the new container first (%s), stopping the old one first" %
+                                      e.output.strip().split('\n')[-1])
+            self._remove_replacement(temp_name)
+            return False
+        self.change_reason.append("Executed 'docker run' (" + temp_name + ")")
+        self.changed = True
+
+        info = (self.docker.inspect('container', [temp_name]) or [dict()])[0]
+        condition = 'healthy' if (info.get('State') or dict()).get('Health') else 'running'
+        try:
+            with self.timings.phase('wait'):
+                self.docker.wait(temp_name, condition, self.wait_timeout)
+        except CalledProcessError:
+            # The old container keeps running
+            self._remove_replacement(temp_name)
+            raise
+
+        self.stop()
+        self.remove()
+        self._invalidate('container', temp_name)
+        with self.timings.phase('rename'):
+            self.docker.rename(temp_name, self.name)
+        self.change_reason.append("Executed 'docker rename' (" + temp_name + " -> " + self.name + ")")
+        self.ran_command = self.run_command_str
+        self.ran_spec = self.run_spec
+        self.timestamps['ran'] = time.time()
+        return True
+
+    def _remove_replacement(self, temp_name):
+        """
+        Remove a new container that didn't replace the old one.
+
+        :param temp_name: The temporary name of the new container.
+        """
+
+        self._invalidate('container', temp_name)
+        info = self.docker.inspect('container', [temp_name])
+        if not info:
+            return
+        with self.timings.phase('remove'):
+            if info[0]['State'].get('Running'):
+                self.docker.stop(temp_name)
+            self.docker.remove(temp_name)
+        self.change_reason.append("Removed the new container (" + temp_name + ")")
+
+    def reload(self):
+        """
+        Make the container reload its configuration, with 'reload_command'
+        if there is one and by sending it 'reload_signal' otherwise.
+        """
+
+        if self.check_mode:
+            return self._plan('reload')
+
+        self._invalidate('container', self.name)
+        with self.timings.phase('reload'):
+            if self.reload_command:
+                self.docker.exec_in(self.name, self.reload_command)
+                self.change_reason.append("Executed 'docker exec' (" + ' '.join(self.reload_command) + ")")
+            else:
+                self.docker.kill(self.name, self.reload_signal)
+                self.change_reason.append("Executed 'docker kill --signal " + self.reload_signal + "'")
+        self.changed = True
+
     def stop(self):
         """
         Stop the docker container.
         """
 
+        if self.check_mode:
+            return self._plan('stop')
+
         self.change_reason.append("Executed 'docker stop'")
-        exec_command(['docker', 'stop', self.name], stderr=STDOUT, universal_newlines=True)
+        self._invalidate('container', self.name)
+        with self.timings.phase('stop'):
+            self.docker.stop(self.name)
         self.changed = True
 
     def remove(self):
@@ -361,8 +3453,13 @@ class Container:
         Remove the docker container.
         """
 
+        if self.check_mode:
+            return self._plan('remove')
+
         self.change_reason.append("Executed 'docker rm'")
-        exec_command(['docker', 'rm', self.name], stderr=STDOUT, universal_newlines=True)
+        self._invalidate('container', self.name)
+        with self.timings.phase('remove'):
+            self.docker.remove(self.name)
         self.changed = True
 
     def build(self):
@@ -370,18 +3467,233 @@ class Container:
         Build the docker image of the container.
         """
 
+        if self.check_mode:
+            self.image_updated = True
+            return self._plan('build')
+
+        # Label the image with what it is built from. The labels are not part
+        # of the build command we store, because the digest changes with
+        # every change in the build context.
+        build_command = self.build_command[:-1]
+        build_command.extend(['--label', CONTEXT_DIGEST_LABEL + '=' + (self.build_context_digest or ''),
+                              '--label', BUILD_COMMAND_LABEL + '=' + self._build_command_hash()])
+
+        # Where the layer cache lives doesn't change the image, so it isn't
+        # part of the stored build command either.
+        if self.build_cache:
+            build_command = ['docker', 'buildx'] + build_command[1:] + self._build_cache_args()
+
+        # What the image is built on now
+        if self.build_base_image_ids is None:
+            self.build_base_image_ids = self._base_image_ids()
+
+        if self.background:
+            job = self._job()
+            build_command.extend(['--iidfile', job.iid_path, self.build_command[-1]])
+            self._start_job(job, 'build', build_command, cwd=self.path, build_command=self.build_command_str,
+                            context_digest=self.build_context_digest or '',
+                            base_image_ids=self.build_base_image_ids, build_cache=self.build_cache)
+            return
+
+        # Docker writes the ID of the new image to this file
+        iid_fd, iid_path = tempfile.mkstemp(prefix='.iid-', dir=DOCKER_COMMANDS_PATH)
+        os.close(iid_fd)
+        build_command.extend(['--iidfile', iid_path])
+        build_command.append(self.build_command[-1])
+
         # Makes sure this runs in the directory where the Dockerfile is,
         # otherwise the command would be wrong.
-        exec_command(self.build_command, cwd=self.path, stderr=STDOUT, universal_newlines=True)
-        self.change_reason.append("Executed 'docker build'")
+        self._invalidate('image', self.image)
+        try:
+            with self.timings.phase('build'):
+                self.docker.build(build_command, self.path, self._output())
+            with open(iid_path) as iid_file:
+                self.image_id = iid_file.read().strip() or None
+        finally:
+            os.remove(iid_path)
+        self.context_digest = self.build_context_digest or ''
+        self.base_image_ids = self.build_base_image_ids
+        self.built_command = self.build_command_str
+        self.timestamps['built'] = time.time()
+        self.image_updated = True
+        self.change_reason.append("Executed '%s'" % ' '.join(build_command[:3 if self.build_cache else 2]))
         self.changed = True
+        self._swap_build_cache(self.build_cache)
+        self._remove_old_images()
+
+    def _build_cache_args(self):
+        """
+        Get the arguments of 'docker buildx build' that import the layer
+        cache of the image from its cache directory and export the new cache
+        next to it (see _swap_build_cache()).
+
+        :return: A list with the arguments.
+        """
+
+        # What a failed build left behind
+        shutil.rmtree(self.build_cache + '.new', ignore_errors=True)
+        os.makedirs(os.path.dirname(self.build_cache), mode=0o700, exist_ok=True)
+
+        args = []
+        if os.path.isdir(self.build_cache):
+            args.extend(['--cache-from', 'type=local,src=' + self.build_cache])
+        # The image has to end up in the image store of docker, not only in
+        # the cache of the builder.
+        args.extend(['--cache-to', 'type=local,mode=max,dest=' + self.build_cache + '.new', '--load'])
+        return args
+
+    @staticmethod
+    def _swap_build_cache(build_cache):
+        """
+        Replace the cache directory of an image with the cache its last build
+        exported. Exporting into the directory the cache is imported from
+        would let it grow forever, BuildKit never removes anything from it.
+
+        :param build_cache: The cache directory of the image (None if the
+                            image is not built with a cache directory).
+        """
+
+        if not build_cache or not os.path.isdir(build_cache + '.new'):
+            return
+        shutil.rmtree(build_cache + '.old', ignore_errors=True)
+        if os.path.exists(build_cache):
+            os.rename(build_cache, build_cache + '.old')
+        os.rename(build_cache + '.new', build_cache)
+        shutil.rmtree(build_cache + '.old', ignore_errors=True)
+
+    def _remove_old_images(self):
+        """
+        Remember the image that was just built and remove the ones built
+        before it, except for the last 'keep_images' (the new one included).
+        Images that are still used by a container are kept until they are
+        not anymore.
+        """
+
+        if self.image_id:
+            self.image_history = [self.image_id] + [image_id for image_id in self.image_history
+                                                    if image_id != self.image_id]
+
+        # Without 'keep_images', we only remember the current image
+        if self.keep_images <= 0:
+            self.image_history = self.image_history[:1]
+            return
+        if len(self.image_history) <= self.keep_images:
+            return
+
+        kept = self.image_history[:self.keep_images]
+        removed = []
+        steps = dict()
+        with self.timings.phase('remove_images'):
+            for info in self.docker.inspect('image', self.image_history[self.keep_images:]):
+                # The sizes of the layers are gone with the image
+                try:
+                    steps[info['Id']] = self.docker.image_history(info['Id'])
+                except (CalledProcessError, ValueError):
+                    steps[info['Id']] = []
+                try:
+                    self.docker.remove_image(info['Id'])
+                except CalledProcessError:
+                    kept.append(info['Id'])
+                    continue
+                removed.append(info)
+            if removed:
+                self.reclaimed_bytes += self._reclaimed_bytes(removed, steps)
+
+        # Images that don't exist anymore are forgotten
+        self.image_history = kept
+        if removed:
+            self.change_reason.append("Removed %d old image(s), %d bytes reclaimed" %
+                                      (len(removed), self.reclaimed_bytes))
+
+    def _reclaimed_bytes(self, removed, steps):
+        """
+        Work out how much space removing images freed. Images share the
+        layers they have in common (e.g. those of their base image), so only
+        the layers of the removed images that no remaining image uses count,
+        and each of them only once.
+
+        :param removed: The inspect results of the removed images.
+        :param steps: A dict mapping their IDs to their image_history().
+        :return: The number of bytes.
+        """
+
+        def chains(layers):
+            # Like docker, we identify a layer by itself and all layers below
+            # it, so layers are only shared by images with the same bottom.
+            chain = hashlib.sha256()
+            for layer in layers:
+                chain.update(layer.encode('utf-8') + b'\n')
+                yield chain.hexdigest()
+
+        used = set()
+        for layers in self.docker.image_layers():
+            used.update(chains(layers))
+
+        reclaimed = 0
+        for info in removed:
+            layer_chains = list(chains((info.get('RootFS') or dict()).get('Layers') or []))
+            freed = len([chain for chain in layer_chains if chain not in used])
+            used.update(layer_chains)
+
+            # The freed layers are the top ones. Only steps with a size surely
+            # added a layer, empty layers could be anywhere. We count them as
+            # freed, so we never report more than was freed.
+            sizes = [size for size in steps.get(info['Id'], []) if size]
+            freed = min(len(sizes), max(0, freed - (len(layer_chains) - len(sizes))))
+            reclaimed += sum(sizes[len(sizes) - freed:])
+        return reclaimed
+
+    def _output(self):
+        """
+        Get something to collect the output of a docker command in.
+
+        :return: A CommandOutput.
+        """
+
+        log_path = DOCKER_COMMANDS_PATH + '/' + LOGS_DIR + '/' + self.name + '.log' if self.output_log else None
+        return CommandOutput(self.output_lines, log_path)
+
+    def _invalidate(self, object_type, ref):
+        """
+        Make sure outdated information about a docker object that is about
+        to be changed is not used anymore.
+
+        :param object_type: 'container' or 'image'.
+        :param ref: The name/reference of the object.
+        """
+
+        self.inspected.pop((object_type, ref), None)
+        if self.snapshot:
+            self.snapshot.invalidate(object_type, ref)
+
+    def _build_command_hash(self):
+        """
+        Get a hash of the build command (including the build args).
+
+        :return: The hex digest of the build command.
+        """
+
+        return hashlib.sha256(self.build_command_str.encode('utf-8')).hexdigest()
 
     def pull(self):
         """
         Pull the image of the container from the registry.
         """
 
-        exec_command(['docker', 'pull', self.image], stderr=STDOUT, universal_newlines=True)
+        if self.check_mode:
+            self.image_updated = True
+            return self._plan('pull')
+
+        if self.background:
+            self._start_job(self._job(), 'pull', ['docker', 'pull', self.image])
+            return
+
+        self._invalidate('image', self.image)
+        with self.timings.phase('pull'):
+            self.docker.pull(self.image, self._output())
+        self.image_id = (self._image_info() or dict()).get('Id')
+        self.timestamps['pulled'] = time.time()
+        self.image_updated = True
         self.change_reason.append("Executed 'docker pull'")
         self.changed = True
 
@@ -411,9 +3723,10 @@ class Container:
         # Construct the build command from the bulid_args
         build_command = Container._construct_docker_command('build', **build_args)
 
-        # We use this because in some cases, the creation time is not updated
-        # otherwise
-        build_command.append("--no-cache")
+        # We don't pass '--no-cache' by default, the layer cache is what makes
+        # rebuilds fast. Whether the image is up to date is tracked by the
+        # digest of the build context instead of its creation time. If you
+        # really want to, you can still set 'no_cache' in the build args.
 
         # The last argument is the path to the Dockerfile. We will make sure
         # that we change to the directory where the Dockerfile resides first
@@ -485,7 +3798,9 @@ class Container:
             # It might happen that the value is None
             elif value:
                 # If it's a bool, we only append the key
-                if not isinstance(value, bool):
+                if isinstance(value, bool):
+                    command.append(arg_name)
+                else:
                     # It might be a number that has to be converted to a string first
                     command.extend([arg_name, str(value)])
         return command
@@ -501,13 +3816,32 @@ def run_module():
 
     # Define the available arguments/parameters that a user can pass to the module
     module_args = dict(
-        state=dict(type='str', required=True, default=None, choices=['running', 'stopped', 'restarted', 'built']),
-        name=dict(type='str', required=True, default=None),
+        state=dict(type='str', required=False, default=None, choices=STATES),
+        name=dict(type='str', required=False, default=None),
+        containers=dict(type='list', required=False, default=None),
+        parallel=dict(type='int', required=False, default=1),
+        backend=dict(type='str', required=False, default='auto', choices=['auto', 'cli', 'api']),
+        fact_cache=dict(type='int', required=False, default=0),
         image=dict(type='str', required=False, default=None),
         path=dict(type='str', required=False, default=None),
         command=dict(type='list', required=False, default=None),
         foreground=dict(type='bool', required=False, default=False),
         build_args=dict(type='dict', required=False, default=None),
+        build_cache=dict(type='path', required=False, default=None),
+        pull_check=dict(type='str', required=False, default='exists', choices=['exists', 'digest']),
+        pull_check_ttl=dict(type='int', required=False, default=600),
+        output_lines=dict(type='int', required=False, default=100),
+        output_log=dict(type='bool', required=False, default=False),
+        wait_for=dict(type='str', required=False, default=None, choices=['running', 'healthy']),
+        wait_timeout=dict(type='int', required=False, default=60),
+        job_timeout=dict(type='int', required=False, default=3600),
+        trace=dict(type='bool', required=False, default=False),
+        background=dict(type='bool', required=False, default=False),
+        replace_strategy=dict(type='str', required=False, default='stop_first', choices=['stop_first', 'start_first']),
+        keep_images=dict(type='int', required=False, default=0),
+        reload_on=dict(type='list', required=False, default=None),
+        reload_signal=dict(type='str', required=False, default='HUP'),
+        reload_command=dict(type='list', required=False, default=None),
         add_host=dict(type='list', required=False, default=None),
         blkio_weight=dict(type='int', required=False, default=None),
         blkio_weight_device=dict(type='str', required=False, default=None),
@@ -589,7 +3923,22 @@ def run_module():
     )
 
     # Create an object to communicate with ansible
-    module = AnsibleModule(argument_spec=module_args, supports_check_mode=True)
+    module = AnsibleModule(argument_spec=module_args, supports_check_mode=True,
+                           required_one_of=[['name', 'containers']],
+                           mutually_exclusive=[['name', 'containers']])
+
+    # These arguments apply to the module execution as a whole
+    entries = module.params.pop('containers')
+    parallel = module.params.pop('parallel')
+    fact_cache = module.params.pop('fact_cache')
+    try:
+        docker = docker_backend(module.params.pop('backend'))
+    except Container.InvalidArgumentException as e:
+        return fail(module, 'Invalid argument: ' + str(e))
+
+    # A list of containers is handled separately
+    if entries is not None:
+        return run_batch(module, module_args, entries, parallel, docker, fact_cache)
 
     # The 'state' is a special argument that is handled by this function and
     # not the Container class.
@@ -597,7 +3946,9 @@ def run_module():
 
     # Make sure all arguments that have to be present are here (some of this
     # is already handled by ansible).
-    if state != 'stopped' and 'image' not in module.params:
+    if not state:
+        return fail(module, 'Invalid argument: No state provided')
+    if state != 'stopped' and not module.params['image']:
         return fail(module, 'Invalid argument: No image name provided')
 
     # Create a Container class
@@ -607,27 +3958,392 @@ def run_module():
         return fail(module, 'Invalid argument: ' + str(e))
     except OSError as e:
         return fail(module, 'Failed to open file to store previous docker commands: ' + str(e))
-    except DistutilsFileError as e:
-        return fail(module, 'Failed to create path to store previous docker commands: ' + str(e))
 
     # Ensure the container is in the desired state
+    container.docker = docker
+    container.check_mode = module.check_mode
+    try:
+        if fact_cache > 0:
+            with container.timings.phase('fact_cache'):
+                container.snapshot = FactCache(docker, DOCKER_COMMANDS_PATH + '/' + FACT_CACHE_FILE, fact_cache)
+        ensure_state(container, state)
+    except CalledProcessError as e:
+        return fail(module, 'Docker command failed: ' + ' '.join(e.cmd) + '\n\n' + e.output,
+                    timings=container.timings.result())
+
+    # Inform ansible that we were successful and whether something changed on
+    # the remote host or not.
+    result = container_result(container)
+    module.exit_json(**result)
+    return result
+
+
+def ensure_state(container, state):
+    """
+    Bring a container into the desired state.
+
+    :param container: The Container.
+    :param state: One of STATES.
+    """
+
     try:
         if state == 'running':
             container.ensure_running()
+            container.wait_until_ready()
         elif state == 'restarted':
             container.ensure_restarted()
+            container.wait_until_ready()
         elif state == 'stopped':
             container.ensure_stopped()
         elif state == 'built':
             container.ensure_image_is_updated()
-    except CalledProcessError as e:
-        return fail(module, 'Docker command failed: ' + ' '.join(e.cmd) + '\n\n' + e.output)
+    finally:
+        # Whatever succeeded before a failure is remembered as well
+        container.save_state()
+        container.save_trace()
+
+
+def update_image(container):
+    """
+    Bring the image of a container up to date, for all containers with that
+    image (see run_batch()).
+
+    :param container: The Container.
+    """
+
+    try:
+        container.ensure_image_is_updated()
+    finally:
+        # Whatever succeeded before a failure is remembered as well
+        container.save_state()
+
+
+def container_result(container):
+    """
+    Get what we report back to ansible about a container.
+
+    :param container: The Container.
+    :return: A dict with the result.
+    """
 
-    # Inform ansible that we were successful and whether something changed on
-    # the remote host or not.
     result = dict(changed=container.changed,
                   change_reason=container.change_reason,
-                  stdout=container.run_stdout)
+                  stdout=container.run_stdout,
+                  timings=container.timings.result())
+    if container.job is not None:
+        result['job'] = container.job
+    if container.keep_images:
+        result['reclaimed_bytes'] = container.reclaimed_bytes
+    if container.time_to_ready is not None:
+        result['time_to_ready'] = container.time_to_ready
+    if container.context_scan is not None:
+        result['context_scan'] = container.context_scan
+    if container.check_mode:
+        result['plan'] = container.plan
+    return result
+
+
+def batch_entry_params(module, module_args, defaults, entry):
+    """
+    Validate an entry of the 'containers' list and convert it to the same
+    form ansible gives us the module parameters in.
+
+    :param module: Interface to ansible.
+    :param module_args: The argument spec of the module.
+    :param defaults: The module parameters that apply to all entries.
+    :param entry: The entry of the 'containers' list.
+    :return: A dict with all module parameters for this entry.
+    """
+
+    if not isinstance(entry, dict):
+        raise Container.InvalidArgumentException("Every entry in 'containers' must be a dict")
+    if not entry.get('name'):
+        raise Container.InvalidArgumentException("Every entry in 'containers' needs a name")
+
+    params = dict((key, spec['default']) for key, spec in module_args.items() if key not in GLOBAL_ARGS)
+    params.update(defaults)
+
+    for key, value in entry.items():
+        if key not in params:
+            raise Container.InvalidArgumentException("Unsupported parameter for container '%s': %s" %
+                                                     (entry['name'], key))
+
+        # Do the same conversions ansible does for the top level parameters
+        value_type = module_args[key]['type']
+        if value is None:
+            pass
+        elif value_type == 'list' and not isinstance(value, list):
+            value = value.split(',') if isinstance(value, str) else [value]
+        elif value_type == 'bool':
+            value = module.boolean(value)
+        elif value_type == 'int':
+            value = int(value)
+        elif value_type == 'str':
+            value = str(value)
+        params[key] = value
+
+    if not params['state']:
+        raise Container.InvalidArgumentException("No state provided for container '%s'" % entry['name'])
+    for key, spec in module_args.items():
+        if params.get(key) is not None and 'choices' in spec and params[key] not in spec['choices']:
+            raise Container.InvalidArgumentException("Invalid %s for container '%s': %s" %
+                                                     (key, entry['name'], params[key]))
+    if params['state'] != 'stopped' and not params['image']:
+        raise Container.InvalidArgumentException("No image name provided for container '%s'" % entry['name'])
+    return params
+
+
+def container_dependencies(params):
+    """
+    Get the names of the containers a container needs to exist before it can
+    be started ('link', 'volumes_from' and 'network: container:<name>').
+
+    :param params: The module parameters of the container.
+    :return: A set with the names of the containers.
+    """
+
+    names = set()
+    for link in params.get('link') or []:
+        names.add(link.split(':')[0])
+    for volumes_from in params.get('volumes_from') or []:
+        names.add(volumes_from.split(':')[0])
+    network = params.get('network') or ''
+    if network.startswith('container:'):
+        names.add(network[len('container:'):])
+    return names
+
+
+def run_in_order(items, dependencies, worker, parallel):
+    """
+    Call a function for every item on a pool of threads. An item is only
+    processed once all items it depends on are done. If processing an item
+    fails, no new items are started anymore.
+
+    :param items: A list of items.
+    :param dependencies: A dict mapping the index of an item to a set with the
+                         indexes of the items that have to be done before.
+    :param worker: The function to call with every item.
+    :param parallel: The maximal number of items processed at the same time.
+    :return: A dict mapping the index of every processed item to the
+             exception it raised (None if it succeeded).
+    """
+
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+    from concurrent.futures import wait as wait_for_futures
+
+    parallel = max(1, parallel)
+    pending = dict((index, set(dependencies.get(index, ()))) for index in range(len(items)))
+    done = dict()
+    running = dict()
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        while pending or running:
+            # Start everything that doesn't wait for anything anymore, in the
+            # order of the list
+            if not any(done.values()):
+                for index in sorted(pending):
+                    if len(running) >= parallel:
+                        break
+                    if not pending[index]:
+                        del pending[index]
+                        running[executor.submit(worker, items[index])] = index
+
+            if not running:
+                break
+
+            finished, _ = wait_for_futures(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                done[index] = future.exception()
+                for waiting_for in pending.values():
+                    waiting_for.discard(index)
+    return done
+
+
+def batch_order(containers):
+    """
+    Figure out which containers have to be handled before which others.
+    Containers are started after the containers they depend on and stopped
+    before them. Their images are already up to date by then (see
+    image_order()).
+
+    :param containers: A list of (Container, state, dependency names) tuples.
+    :return: A dict mapping the index of every container to a set with the
+             indexes of the containers that have to be handled before.
+    """
+
+    indexes = dict((container.name, index) for index, (container, _, _) in enumerate(containers))
+    dependencies = dict((index, set()) for index in range(len(containers)))
+
+    for index, (container, state, names) in enumerate(containers):
+        for name in names:
+            # We don't care about containers that are not managed here
+            if name not in indexes:
+                continue
+            if state == 'stopped':
+                dependencies[indexes[name]].add(index)
+            else:
+                dependencies[index].add(indexes[name])
+
+    check_acyclic(containers, dependencies)
+    return dependencies
+
+
+def image_order(containers):
+    """
+    Pick a container for every image of a list of containers that brings
+    the image up to date, so every image is built or pulled only once. Local
+    images are built after the local images they are built on (see
+    Container.local_base_images()), independent ones can be built at the
+    same time.
+
+    :param containers: A list of (Container, state, dependency names) tuples.
+    :return: A tuple with a dict mapping every image to the index of the
+             container that updates it, and a dict mapping those indexes to
+             sets with the indexes that have to be done before.
+    """
+
+    # Only these states bring the image up to date
+    leaders = dict()
+    for index, (container, state, _) in enumerate(containers):
+        if container.image and state in ('running', 'built'):
+            leaders.setdefault(normalize_image_ref(container.image), index)
+
+    dependencies = dict((index, set()) for index in leaders.values())
+    for index in leaders.values():
+        for base in containers[index][0].local_base_images():
+            if base in leaders and leaders[base] != index:
+                dependencies[index].add(leaders[base])
+
+    check_acyclic(containers, dependencies)
+    return leaders, dependencies
+
+
+def check_acyclic(containers, dependencies):
+    """
+    Make sure we won't wait forever.
+
+    :param containers: A list of (Container, state, dependency names) tuples.
+    :param dependencies: A dict mapping indexes of the containers to sets
+                         with the indexes that have to be done before.
+    :raises InvalidArgumentException: If there is a cycle.
+    """
+
+    remaining = dict((index, set(waiting_for)) for index, waiting_for in dependencies.items())
+    while remaining:
+        ready = [index for index, waiting_for in remaining.items() if not waiting_for]
+        if not ready:
+            names = sorted(containers[index][0].name for index in remaining)
+            raise Container.InvalidArgumentException("Dependency cycle between the containers " + ', '.join(names))
+        for index in ready:
+            del remaining[index]
+        for waiting_for in remaining.values():
+            waiting_for.difference_update(ready)
+
+
+def run_batch(module, module_args, entries, parallel, docker, fact_cache=0):
+    """
+    Manage a list of containers in one module execution. All module
+    parameters besides 'containers' are used as defaults for every entry.
+
+    :param module: Interface to ansible.
+    :param module_args: The argument spec of the module.
+    :param entries: The 'containers' parameter.
+    :param parallel: How many containers may be handled at the same time.
+    :param docker: The DockerCli or DockerApi to use.
+    :param fact_cache: For how many seconds the containers and images on the
+                       host are cached (0 to not cache them).
+    :return: A dict with the results for all containers.
+    """
+
+    defaults = dict((key, value) for key, value in module.params.items() if value is not None)
+
+    # Create all containers first, so we can inspect them all at once
+    containers = []
+    try:
+        for entry in entries:
+            params = batch_entry_params(module, module_args, defaults, entry)
+            state = params.pop('state')
+            if any(container.name == params['name'] for container, _, _ in containers):
+                raise Container.InvalidArgumentException("Container '%s' is listed more than once" % params['name'])
+            dependencies = container_dependencies(params)
+            containers.append((Container(**params), state, dependencies))
+        order = batch_order(containers)
+        leaders, image_dependencies = image_order(containers)
+    except Container.InvalidArgumentException as e:
+        return fail(module, 'Invalid argument: ' + str(e))
+    except (TypeError, ValueError) as e:
+        return fail(module, 'Invalid argument: ' + str(e))
+    except OSError as e:
+        return fail(module, 'Failed to open file to store previous docker commands: ' + str(e))
+
+    # Local images are only inspected if their build context digest is not
+    # known yet, see Container.needs_rebuild().
+    timings = Timings(None)
+    try:
+        with timings.phase('snapshot'):
+            if fact_cache > 0:
+                snapshot = FactCache(docker, DOCKER_COMMANDS_PATH + '/' + FACT_CACHE_FILE, fact_cache)
+            else:
+                snapshot = DockerSnapshot(docker,
+                                          [container.name for container, _, _ in containers],
+                                          [container.image for container, _, _ in containers
+                                           if not container.is_local_image or not container.prev_context_digest])
+    except CalledProcessError as e:
+        return fail(module, 'Docker command failed: ' + ' '.join(e.cmd) + '\n\n' + (e.output or ''),
+                    timings=timings.result())
+    for container, _, _ in containers:
+        container.snapshot = snapshot
+        container.docker = docker
+        container.check_mode = module.check_mode
+
+    # Every image is brought up to date once, before the containers are
+    # handled. The other containers with the same image take it over.
+    for index in image_dependencies:
+        container = containers[index][0]
+        container.base_image_sources = dict((base, containers[leaders[base]][0])
+                                            for base in container.local_base_images() if base in leaders)
+    image_indexes = sorted(image_dependencies)
+    positions = dict((index, position) for position, index in enumerate(image_indexes))
+    with timings.phase('images'):
+        image_errors = run_in_order([containers[index][0] for index in image_indexes],
+                                    dict((positions[index], set(positions[other] for other in waiting_for))
+                                         for index, waiting_for in image_dependencies.items()),
+                                    update_image, parallel)
+    errors = dict((image_indexes[position], error) for position, error in image_errors.items())
+
+    if all(error is None for error in errors.values()):
+        for container, state, _ in containers:
+            if container.image and state in ('running', 'built'):
+                container.image_source = containers[leaders[normalize_image_ref(container.image)]][0]
+        with timings.phase('containers'):
+            errors.update(run_in_order(containers, order, lambda item: ensure_state(item[0], item[1]), parallel))
+    if module.params.get('trace'):
+        timings.write_trace(DOCKER_COMMANDS_PATH + '/' + TRACE_FILE)
+
+    # Report the containers in the order they were given, leaving out the
+    # ones that were not handled because something else failed before.
+    results = []
+    failure = None
+    for index, (container, _, _) in enumerate(containers):
+        if index not in errors:
+            continue
+        result = dict(container_result(container), name=container.name)
+        if errors[index] is not None:
+            result['failed'] = True
+            failure = failure or (container, errors[index])
+        results.append(result)
+
+    if failure:
+        container, e = failure
+        if not isinstance(e, CalledProcessError):
+            raise e
+        return fail(module, "Docker command failed for container '" + container.name + "': " +
+                    ' '.join(e.cmd) + '\n\n' + e.output, results=results, timings=timings.result())
+
+    result = dict(changed=any(entry_result['changed'] for entry_result in results),
+                  results=results,
+                  timings=timings.result())
     module.exit_json(**result)
     return result
 